@@ -0,0 +1,48 @@
+import numpy as np
+import math
+
+##################################################################
+# LANDMARK MEASUREMENTS ##########################################
+##################################################################
+# range-bearing model for many poses and landmarks at once
+# poses (N, 3) as x, y, theta and landmarks (M, 2) as x, y -> one row per pose, one column per landmark
+
+def normalize_angles(angles):
+    # normalize_angle for arrays, result in [-pi, pi)
+    return (angles + math.pi) % (2 * math.pi) - math.pi
+
+def predict_measurements(poses, landmarks):
+    # (N, M) bearings relative to the heading and (N, M) ranges, what a perfect sensor would read from every pose
+    poses = np.asarray(poses, dtype=float).reshape(-1, 3)
+    landmarks = np.asarray(landmarks, dtype=float).reshape(-1, 2)
+    dx = landmarks[:, 0] - poses[:, 0, None]
+    dy = landmarks[:, 1] - poses[:, 1, None]
+    return normalize_angles(np.arctan2(dy, dx) - poses[:, 2, None]), np.hypot(dx, dy)
+
+def measurement_errors(poses, landmarks, measured_ranges, measured_bearings=None, power=2):
+    # (N,) summed |measured - predicted|^power over landmarks, bearings are added only if given
+    # same as predict_measurements followed by the error sum, but every (N, M) temporary is reused in place
+    poses = np.asarray(poses, dtype=float).reshape(-1, 3)
+    landmarks = np.asarray(landmarks, dtype=float).reshape(-1, 2)
+    dx = np.subtract(landmarks[:, 0], poses[:, 0, None])
+    dy = np.subtract(landmarks[:, 1], poses[:, 1, None])
+
+    error = np.hypot(dx, dy)
+    error -= np.asarray(measured_ranges, dtype=float)
+    np.abs(error, out=error)
+    if power != 1:
+        error **= power
+
+    if measured_bearings is not None:
+        bearing = np.arctan2(dy, dx, out=dx)
+        # measured - predicted, wrapped to [-pi, pi): -3.14 and +3.14 are the same direction
+        np.subtract(np.asarray(measured_bearings, dtype=float), bearing, out=bearing)
+        bearing += poses[:, 2, None]
+        bearing += math.pi
+        bearing %= 2 * math.pi
+        bearing -= math.pi
+        np.abs(bearing, out=bearing)
+        if power != 1:
+            bearing **= power
+        error += bearing
+    return error.sum(axis=1)
@@ -0,0 +1,244 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")   # no window, must be set before pygame starts
+
+import pygame
+import math
+import numpy as np
+import argparse
+import json
+import time
+
+from random_streams import RandomStream
+from particle_weights import gaussian_log_likelihood, normalize_log_weights, effective_sample_size
+from particle_filter_game import Environment, Sensor, RangeTable, keys_to_command, WINDOW_WIDTH, WINDOW_HEIGHT, FPS, STOP_MARGIN
+from particle_filter_benchmark import DEFAULT_SCRIPT, MAP_FILEPATH, expand_script
+
+##################################################################
+# CONSTANTS ######################################################
+##################################################################
+NUM_FILTERS = 64
+NUM_PARTICLES = 200
+NUM_FRAMES = 300
+
+##################################################################
+# CLASSES ########################################################
+##################################################################
+class BatchSimulator:
+    # K independent robot + particle filter pairs on one shared map, stepped together
+    # robots: (K, 3), particles: (K, N, 3), weights: (K, N) - one array op per stage for all filters
+    # tuning parameters (variance, motion noise) can be a scalar or one value per filter
+    def __init__(self, env: Environment, num_filters: int, num_particles: int, sensor: Sensor,
+                 variance=200.0, noise_v=0.1, noise_w=0.05, motion_check: str = "endpoint",
+                 ray_casting: str = "march", range_table: RangeTable = None, rng: RandomStream = None):
+        if motion_check not in ("endpoint", "stop"):
+            raise ValueError(f"Unknown motion check '{motion_check}'")
+        if ray_casting not in ("march", "dda"):
+            raise ValueError(f"Unknown ray casting method '{ray_casting}'")
+
+        self.env = env                  # shared, nothing of the map is copied per filter
+        self.num_filters = num_filters
+        self.num_particles = num_particles
+        self.motion_check = motion_check
+        self.ray_casting = ray_casting
+        self.range_table = range_table
+        self.__rng = rng if rng is not None else RandomStream()
+
+        self.variance = np.broadcast_to(np.asarray(variance, dtype=float), (num_filters,))
+        self.noise_v = np.broadcast_to(np.asarray(noise_v, dtype=float), (num_filters,))
+        self.noise_w = np.broadcast_to(np.asarray(noise_w, dtype=float), (num_filters,))
+
+        # same beams as the game filter uses (every 5th of the lidar)
+        self.max_range = sensor.max_range
+        self.noise_std = sensor.noise_std
+        self.phis = sensor.relative_angles[::5]
+        self.__scan_step = 4.0
+
+        self.max_v = 120.0
+        self.max_w = 4.0
+
+        self.num_kept = int(num_particles * 0.2)
+        self.num_generated = int(num_particles * 0.1)
+        self.num_choosed = num_particles - self.num_kept - self.num_generated
+        self.num_estimated = int(num_particles * 0.1)
+
+        # every robot starts at its own random free pose, every filter with a global uniform guess
+        x, y = env.sample_free(num_filters, self.__rng)
+        self.robots = np.column_stack((x, y, self.__rng.uniform(0, 2 * math.pi, num_filters)))
+        self.particles = self._generate_random_particles(num_filters * num_particles).reshape(num_filters, num_particles, 3)
+        self.weights = np.full((num_filters, num_particles), 1.0 / num_particles)
+        self.ess = np.full(num_filters, float(num_particles))
+        self.estimates = np.zeros((num_filters, 3))
+
+    def step(self, cmd_v, cmd_w, dt: float) -> tuple[np.ndarray, np.ndarray]:
+        # one tick of all pairs: move robots, scan, predict, weight, resample, estimate
+        # cmd_v, cmd_w: scalar (all robots get the same command) or one per robot
+        v, w = self.move_robots(cmd_v, cmd_w, dt)
+        distances, valid = self.scan()
+        self.predict(v, w, dt)
+        self.update_weights(distances, valid)
+        self.resample()
+        self.estimate()
+        return self.estimates, self.errors
+
+    @property
+    def errors(self) -> np.ndarray:
+        return np.hypot(self.estimates[:, 0] - self.robots[:, 0], self.estimates[:, 1] - self.robots[:, 1])
+
+    def move_robots(self, cmd_v, cmd_w, dt: float) -> tuple[np.ndarray, np.ndarray]:
+        cmd_v = np.broadcast_to(np.asarray(cmd_v, dtype=float), (self.num_filters,))
+        cmd_w = np.broadcast_to(np.asarray(cmd_w, dtype=float), (self.num_filters,))
+        x, y, theta = self.robots.T
+        new_theta = theta + cmd_w * dt
+        new_x, new_y, free = self._move(x, y, new_theta, cmd_v, dt)
+        self.robots = np.column_stack((new_x, new_y, new_theta))
+        # odometry is what the robots really drove
+        return cmd_v * free, cmd_w
+
+    def scan(self) -> tuple[np.ndarray, np.ndarray]:
+        # (K, B) noisy ranges and a mask of beams that hit something (misses are not used, as in the game)
+        x, y, theta = self.robots.T
+        exact = self.env.cast_rays_crossings(x[:, None], y[:, None], theta[:, None] + self.phis, self.max_range)
+        valid = exact < self.max_range
+        return exact + self.__rng.normal(0, self.noise_std, exact.shape), valid
+
+    def predict(self, v: np.ndarray, w: np.ndarray, dt: float) -> None:
+        shape = (self.num_filters, self.num_particles)
+        noisy_v = v[:, None] + self.__rng.normal(0, 1, shape) * self.noise_v[:, None]
+        noisy_w = w[:, None] + self.__rng.normal(0, 1, shape) * self.noise_w[:, None]
+
+        x, y, theta = self.particles.reshape(-1, 3).T
+        new_theta = theta + noisy_w.ravel() * dt
+        new_x, new_y, _ = self._move(x, y, new_theta, noisy_v.ravel(), dt)
+        self.particles = np.column_stack((new_x, new_y, new_theta)).reshape(self.num_filters, self.num_particles, 3)
+
+    def update_weights(self, distances: np.ndarray, valid: np.ndarray) -> None:
+        # all K * N particles are scored in one call, each against the scan of its own robot
+        particles = self.particles.reshape(-1, 3)
+        real_distances = np.repeat(distances, self.num_particles, axis=0)
+        x, y, theta = particles.T
+        angles = theta[:, None] + self.phis
+        if self.range_table is not None:
+            expected = self.range_table.lookup(x[:, None], y[:, None], angles)
+        elif self.ray_casting == "march":
+            expected = self.env.cast_rays_march(x[:, None], y[:, None], angles, self.max_range, self.__scan_step)
+        else:
+            expected = self.env.cast_rays_dda(x[:, None], y[:, None], angles, self.max_range)
+        squared = np.where(np.repeat(valid, self.num_particles, axis=0), (real_distances - expected) ** 2, 0.0)
+        squared_errors = squared.sum(axis=1).reshape(self.num_filters, self.num_particles)
+
+        # exp(-e^2 / variance) of every beam, multiplied in the log domain and normalized row by row
+        self.weights = normalize_log_weights(gaussian_log_likelihood(squared_errors, np.sqrt(self.variance / 2)[:, None]))
+        self.ess = effective_sample_size(self.weights)
+
+    def resample(self) -> None:
+        # same mix as the game filter: systematic draws with noise, fresh random particles and the best ones kept
+        K, N = self.num_filters, self.num_particles
+        flat = self.particles.reshape(-1, 3)
+        offsets = (np.arange(K) * N)[:, None]
+
+        chosen = systematic_resample_rows(self.weights, self.num_choosed, self.__rng) + offsets
+        chosen_particles = flat[chosen] + self.__rng.normal(0, (2, 2, 0.2), (K, self.num_choosed, 3))
+        generated_particles = self._generate_random_particles(K * self.num_generated).reshape(K, self.num_generated, 3)
+        kept = np.argpartition(self.weights, N - self.num_kept, axis=1)[:, N - self.num_kept:] + offsets
+
+        self.particles = np.concatenate((chosen_particles, generated_particles, flat[kept]), axis=1)
+        flat_weights = self.weights.ravel()
+        weights = np.concatenate((flat_weights[chosen], np.zeros((K, self.num_generated)), flat_weights[kept]), axis=1)
+        self.weights = weights / weights.sum(axis=1, keepdims=True)
+
+    def estimate(self) -> None:
+        N = self.num_particles
+        best = np.argpartition(self.weights, N - self.num_estimated, axis=1)[:, N - self.num_estimated:]
+        x, y, theta = np.take_along_axis(self.particles, best[:, :, None], axis=1).transpose(2, 0, 1)
+        self.estimates = np.column_stack((x.mean(axis=1), y.mean(axis=1), np.arctan2(np.sin(theta).mean(axis=1), np.cos(theta).mean(axis=1))))
+
+    def _move(self, x: np.ndarray, y: np.ndarray, theta: np.ndarray, v: np.ndarray, dt: float) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        new_x = x + v * dt * np.cos(theta)
+        new_y = y + v * dt * np.sin(theta)
+        if self.motion_check == "endpoint":
+            free = (~self.env.is_collision_batch(new_x, new_y)).astype(float)
+        else:
+            free = self.env.sweep_batch(x, y, new_x, new_y)
+            blocked = free < 1.0
+            free[blocked] = np.maximum(free[blocked] - STOP_MARGIN / np.maximum(np.abs(v[blocked]) * dt, 1e-12), 0.0)
+        return x + free * (new_x - x), y + free * (new_y - y), free
+
+    def _generate_random_particles(self, num_particles: int) -> np.ndarray:
+        x, y = self.env.sample_free(num_particles, self.__rng)
+        return np.column_stack((x, y, self.__rng.uniform(0, 2 * math.pi, num_particles)))
+
+def systematic_resample_rows(weights: np.ndarray, num_samples: int, rng: RandomStream) -> np.ndarray:
+    # systematic_resample of the game for every row at once: (K, N) weights -> (K, num_samples) indices
+    cumulative = np.cumsum(weights, axis=1)
+    cumulative[:, -1] = 1.0
+    pointers_below = np.floor(cumulative * num_samples - rng.random((len(weights), 1))).astype(int) + 1
+    counts = np.diff(np.clip(pointers_below, 0, num_samples), axis=1, prepend=0)
+    # every row has exactly num_samples copies, so the flat repeat splits back into rows
+    flat = np.repeat(np.arange(weights.size), counts.ravel())
+    return flat.reshape(len(weights), num_samples) % weights.shape[1]
+
+##################################################################
+# MAIN ###########################################################
+##################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Many robot + particle filter pairs on one map, e.g. to compare tuning parameters")
+    parser.add_argument("--filters", type=int, default=NUM_FILTERS)
+    parser.add_argument("--particles", type=int, default=NUM_PARTICLES)
+    parser.add_argument("--frames", type=int, default=NUM_FRAMES)
+    parser.add_argument("--map", default=MAP_FILEPATH)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--variance", type=float, nargs="+", default=[200.0], help="filters are split evenly between the values")
+    parser.add_argument("--motion-check", default="endpoint", choices=["endpoint", "stop"])
+    parser.add_argument("--ray-casting", default="table", choices=["table", "march", "dda"], help="table = precomputed RangeTable, built once per map")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    pygame.init()
+    pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+    env = Environment(args.map)
+    sensor = Sensor(360.0, 60, 0.5, 200)
+    range_table = RangeTable(env, sensor.max_range) if args.ray_casting == "table" else None
+
+    variance = np.array(args.variance)[np.arange(args.filters) % len(args.variance)]
+    sim = BatchSimulator(env, args.filters, args.particles, sensor, variance=variance, motion_check=args.motion_check,
+                         ray_casting="march" if args.ray_casting == "table" else args.ray_casting, range_table=range_table, rng=RandomStream(args.seed))
+
+    dt = 1.0 / FPS
+    errors = []
+    start = time.perf_counter()
+    for keys in expand_script(DEFAULT_SCRIPT, args.frames):
+        _, frame_errors = sim.step(*keys_to_command(keys, sim.max_v, sim.max_w), dt)
+        errors.append(frame_errors)
+    wall_time = time.perf_counter() - start
+    pygame.quit()
+
+    errors = np.array(errors)
+    report = {
+        "config": vars(args),
+        "wall_time_s": wall_time,
+        "ms_per_tick": wall_time / args.frames * 1000.0,
+        "filter_steps_per_second": args.filters * args.frames / wall_time,
+        "variance": {
+            str(value): {
+                "mean_position_error": float(errors[:, variance == value].mean()),
+                "final_position_error": float(errors[-1, variance == value].mean()),
+                "localized": float((errors[-1, variance == value] < 10.0).mean()),
+            } for value in args.variance
+        },
+    }
+
+    print(f"\n ---- BATCH OF {args.filters} FILTERS x {args.particles} PARTICLES, {args.frames} FRAMES ---- \n")
+    print(f"{report['ms_per_tick']:.1f} ms per tick, {report['filter_steps_per_second']:.0f} filter steps per second\n")
+    print(f"{'variance':<12}{'mean err [px]':>16}{'final err [px]':>16}{'localized':>12}")
+    for value, stats in report["variance"].items():
+        print(f"{value:<12}{stats['mean_position_error']:>16.1f}{stats['final_position_error']:>16.1f}{stats['localized']:>12.0%}")
+    print()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Report saved to {args.output}")
+
+##################################################################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")   # no window, must be set before pygame starts
+
+import pygame
+import numpy as np
+import argparse
+import json
+import time
+
+from random_streams import RandomStream
+from session_log import SessionRecorder
+from particle_filter_game import Environment, Sensor, Robot, ParticleFilter, WINDOW_WIDTH, WINDOW_HEIGHT, FPS
+
+##################################################################
+# CONSTANTS ######################################################
+##################################################################
+NUM_FRAMES = 300
+NUM_PARTICLES = 800
+NUM_BEAMS = 60
+MAP_FILEPATH = os.path.join(".", "img", "map2.bmp")
+
+# (number of frames, pressed keys) - same keys as in the game
+DEFAULT_SCRIPT = [
+    (30, "w"), (15, "d"), (45, "w"), (15, "a"), (45, "w"),
+    (30, "s"), (20, "d"), (40, "w"), (30, ""),
+]
+
+STAGES = ["move", "sense", "predict", "update_weights", "resample", "estimate", "draw"]
+FILTER_STAGES = ["predict", "update_weights", "resample"]
+
+##################################################################
+# CLASSES ########################################################
+##################################################################
+class ScriptedKeys:
+    # stands in for pygame.key.get_pressed(), Robot.update only indexes it
+    def __init__(self, pressed: str):
+        self.pressed = {pygame.key.key_code(key) for key in pressed}
+
+    def __getitem__(self, key: int) -> bool:
+        return key in self.pressed
+
+def load_script(filepath: str) -> list[tuple[int, str]]:
+    with open(filepath) as f:
+        return [(int(frames), keys) for frames, keys in json.load(f)]
+
+def expand_script(script: list[tuple[int, str]], num_frames: int) -> list[ScriptedKeys]:
+    # script is repeated until it covers all frames
+    frames = []
+    while len(frames) < num_frames:
+        for count, keys in script:
+            frames.extend([ScriptedKeys(keys)] * count)
+    return frames[:num_frames]
+
+class StageTimer:
+    def __init__(self, stages: list[str]):
+        self.samples = {stage: [] for stage in stages}
+
+    def measure(self, stage: str, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.samples[stage].append(time.perf_counter() - start)
+        return result
+
+    def summary(self) -> dict:
+        report = {}
+        for stage, samples in self.samples.items():
+            if not samples:
+                # stage never ran (e.g. an empty session log)
+                report[stage] = {"total_ms": 0.0, "mean_ms": 0.0, "p50_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+                continue
+            samples_ms = np.array(samples) * 1000.0
+            report[stage] = {
+                "total_ms": float(samples_ms.sum()),
+                "mean_ms": float(samples_ms.mean()),
+                "p50_ms": float(np.percentile(samples_ms, 50)),
+                "p95_ms": float(np.percentile(samples_ms, 95)),
+                "max_ms": float(samples_ms.max()),
+            }
+        return report
+
+##################################################################
+# BENCHMARK ######################################################
+##################################################################
+def run_benchmark(num_particles: int, num_frames: int, script: list[tuple[int, str]], map_filepath: str = MAP_FILEPATH, num_beams: int = NUM_BEAMS, seed: int = None, record_filepath: str = None, **pf_kwargs) -> dict:
+    pygame.init()
+    pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+    screen = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT))
+
+    env = Environment(map_filepath)
+    rng_sensor, rng_filter = RandomStream(seed).spawn(2)
+    lidar = Sensor(360.0, num_beams, 0.5, 200, rng=rng_sensor)
+    robot = Robot(x=100, y=200, theta=3, sensor=lidar, motion_check="endpoint" if pf_kwargs.get("motion_check", "endpoint") == "endpoint" else "stop")
+    pf = ParticleFilter(num_particles, env, None, rng=rng_filter, **pf_kwargs)
+
+    recorder = None
+    if record_filepath is not None:
+        recorder = SessionRecorder(record_filepath, {
+            "map": map_filepath,
+            "fps": FPS,
+            "sensor": {"fov_degrees": 360.0, "num_rays": lidar.num_rays, "noise_std": lidar.noise_std, "max_range": lidar.max_range},
+        })
+
+    # fixed time step, the motion model does not depend on how fast we run
+    dt = 1.0 / FPS
+    timer = StageTimer(STAGES)
+    errors = []
+    particle_counts = []
+    ess = []
+    start = time.perf_counter()
+    for keys in expand_script(script, num_frames):
+        v, w = timer.measure("move", robot.update, keys, dt, env)
+        timer.measure("sense", robot.do_scan, env)
+        if recorder is not None:
+            recorder.write(keys, v, w, dt, (robot.x, robot.y, robot.theta), robot.last_scan)
+        particle_counts.append(len(pf.particles))
+        timer.measure("predict", pf.predict, v, w, dt, env)
+        timer.measure("update_weights", pf.update_weights, robot.last_scan, lidar, env)
+        ess.append(pf.ess)
+        timer.measure("resample", pf.resample, env)
+        timer.measure("estimate", pf.estimate)
+        timer.measure("draw", pf.draw, screen, True, True)
+        errors.append(np.hypot(pf.x_estimated - robot.x, pf.y_estimated - robot.y))
+    wall_time = time.perf_counter() - start
+    if recorder is not None:
+        recorder.close()
+    pf.close()
+    pygame.quit()
+
+    stages = timer.summary()
+    filter_time = sum(stages[stage]["total_ms"] for stage in FILTER_STAGES) / 1000.0
+    return {
+        "config": {
+            "map": map_filepath,
+            "num_particles": num_particles,
+            "num_frames": num_frames,
+            "num_beams": num_beams,
+            "seed": seed,
+            **pf_kwargs,
+        },
+        "stages": stages,
+        "wall_time_s": wall_time,
+        "frames_per_second": num_frames / wall_time,
+        "particles_per_second": sum(particle_counts) / filter_time,
+        "mean_particle_count": float(np.mean(particle_counts)),
+        "final_particle_count": particle_counts[-1],
+        "mean_effective_sample_size": float(np.mean(ess)),
+        "final_position_error": float(errors[-1]),
+        "mean_position_error": float(np.mean(errors)),
+    }
+
+def run_scaling(num_particles: int, num_frames: int, script: list[tuple[int, str]], map_filepath: str, num_beams: int, seed: int, workers: list[int], **pf_kwargs) -> dict:
+    reports = [run_benchmark(num_particles, num_frames, script, map_filepath, num_beams, seed, num_workers=n, **pf_kwargs) for n in workers]
+    baseline = reports[0]["stages"]["update_weights"]["total_ms"]
+    return {
+        "runs": reports,
+        "update_weights_speedup": {str(n): baseline / r["stages"]["update_weights"]["total_ms"] for n, r in zip(workers, reports)},
+    }
+
+def print_scaling(scaling: dict) -> None:
+    print("\n ---- UPDATE WEIGHTS SCALING ---- \n")
+    print(f"{'workers':<10}{'mean [ms]':>12}{'speedup':>10}")
+    for report, (workers, speedup) in zip(scaling["runs"], scaling["update_weights_speedup"].items()):
+        print(f"{workers:<10}{report['stages']['update_weights']['mean_ms']:>12.3f}{speedup:>10.2f}")
+    print(f"\n(machine has {os.cpu_count()} CPUs)\n")
+
+def print_report(report: dict) -> None:
+    print(f"\n ---- PARTICLE FILTER BENCHMARK ({report['config']['num_particles']} particles, {report['config']['num_frames']} frames) ---- \n")
+    print(f"{'stage':<16}{'mean [ms]':>12}{'p95 [ms]':>12}{'total [ms]':>12}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<16}{stats['mean_ms']:>12.3f}{stats['p95_ms']:>12.3f}{stats['total_ms']:>12.1f}")
+    print(f"\nframes per second:    {report['frames_per_second']:.1f}")
+    print(f"particles per second: {report['particles_per_second']:.0f}")
+    print(f"particles per frame:  {report['mean_particle_count']:.0f} (final {report['final_particle_count']})")
+    print(f"ESS per frame:        {report['mean_effective_sample_size']:.0f} (effective sample size after weighting)")
+    print(f"mean position error:  {report['mean_position_error']:.1f} px\n")
+
+##################################################################
+# MAIN ###########################################################
+##################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Headless benchmark of the particle filter game")
+    parser.add_argument("--particles", type=int, default=NUM_PARTICLES)
+    parser.add_argument("--frames", type=int, default=NUM_FRAMES)
+    parser.add_argument("--map", default=MAP_FILEPATH)
+    parser.add_argument("--seed", type=int, default=0, help="same seed -> identical run, comparable between versions")
+    parser.add_argument("--beams", type=int, default=NUM_BEAMS, help="number of lidar beams")
+    parser.add_argument("--script", help="JSON list of [frames, keys] pairs, e.g. [[30, \"w\"], [10, \"wd\"]]")
+    parser.add_argument("--ray-casting", default="march", choices=["python", "march", "dda"])
+    parser.add_argument("--measurement-model", default="beam", choices=["beam", "likelihood_field"], help="likelihood_field tracks well, but needs ~5000 particles to localize from a random start")
+    parser.add_argument("--resampling", default="systematic", choices=["multinomial", "systematic", "stratified", "residual"])
+    parser.add_argument("--adaptive", action="store_true", help="KLD-sampling between --min-particles and --max-particles")
+    parser.add_argument("--min-particles", type=int, default=100)
+    parser.add_argument("--max-particles", type=int, default=5000)
+    parser.add_argument("--pyramid-levels", type=int, default=1, help="coarse-to-fine scoring after a reset, 1 = off")
+    parser.add_argument("--motion-check", default="endpoint", choices=["endpoint", "stop", "reject"], help="collision test of robot and particle moves")
+    parser.add_argument("--render-mode", default="points", choices=["points", "heatmap"])
+    parser.add_argument("--render-every", type=int, default=1, help="redraw particles only every n-th frame")
+    parser.add_argument("--workers", type=int, default=1, help="processes used by update_weights")
+    parser.add_argument("--scaling", action="store_true", help="compare update_weights with 1, 2, 4 and 8 workers")
+    parser.add_argument("--record", help="also save the run as a session log for particle_filter_replay.py")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    script = load_script(args.script) if args.script else DEFAULT_SCRIPT
+    pf_kwargs = {
+        "ray_casting": args.ray_casting,
+        "measurement_model": args.measurement_model,
+        "resampling": args.resampling,
+        "pyramid_levels": args.pyramid_levels,
+        "motion_check": args.motion_check,
+        "render_mode": args.render_mode,
+        "render_every": args.render_every,
+    }
+    if args.adaptive:
+        pf_kwargs.update(adaptive=True, min_particles=args.min_particles, max_particles=args.max_particles)
+    if args.scaling:
+        report = run_scaling(args.particles, args.frames, script, args.map, args.beams, args.seed, [1, 2, 4, 8], **pf_kwargs)
+        print_scaling(report)
+    else:
+        report = run_benchmark(args.particles, args.frames, script, args.map, args.beams, args.seed, args.record, num_workers=args.workers, **pf_kwargs)
+        print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Report saved to {args.output}")
+
+##################################################################
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
 import numpy as np
 import pylab as plt
-import random
+
+from random_streams import RandomStream
+from landmark_measurements import measurement_errors
+from particle_weights import gaussian_log_likelihood, reweight, SelectiveResampler
 
 ##################################################################
 # CONSTANTS ######################################################
@@ -9,6 +12,8 @@ import random
 # --- particle filter
 NUM_PARTICLES = 500
 NUM_STEPS = 20
+SEED = None                     # set an int to get the same run every time
+RESAMPLE_THRESHOLD = 0.5        # resample only when the effective sample size drops below this share of particles (1.0 = every step)
 
 # --- environment
 # try to change number or position of landmarks
@@ -24,6 +29,7 @@ STEP_DISTANCE = 1
 # --- distribution constants (std)
 SIGMA_DISTANCE = 0.5            # uncertainty in driving forward
 SIGMA_ANGLE = 0.3               # uncertainty in steering
+SIGMA_MEASUREMENT = 0.1         # how much we trust one distance reading
 
 # --- animation
 ANIM_PAUSE_S = 0.3
@@ -42,15 +48,15 @@ def motion_model(state, d_phi=0.0, distance=STEP_DISTANCE):
 
 # robot's movement is not perfect, it moves with ceratin amount of noise
 # (steers a bit more/less, goes a bit faster/slower)
-def move_robot(robot_state):
-    d_phi = random.gauss(0.0, 0.01)                     # noise in steering
-    distance = random.gauss(STEP_DISTANCE, 0.01)        # noise in driving forward
+def move_robot(robot_state, rng):
+    d_phi = rng.gauss(0.0, 0.01)                        # noise in steering
+    distance = rng.gauss(STEP_DISTANCE, 0.01)           # noise in driving forward
     return motion_model(robot_state, d_phi, distance)   # returning precise motion model with added noise
 
 # the same as robot, but we set the STDs ourselves - we choose how much we trust the robot's motion
-def move_particle(particle_state):
-    d_phi = random.gauss(0, SIGMA_ANGLE)
-    distance = random.gauss(STEP_DISTANCE, SIGMA_DISTANCE)
+def move_particle(particle_state, rng):
+    d_phi = rng.gauss(0, SIGMA_ANGLE)
+    distance = rng.gauss(STEP_DISTANCE, SIGMA_DISTANCE)
     return motion_model(particle_state, d_phi)
 
 ##################################################################
@@ -64,43 +70,39 @@ def calculate_distance(point_a, point_b):
     return np.sqrt((xa - xb)**2 + (ya - yb)**2)
 
 # simulation of real sensor with noise
-def measure_distance(state, target):
+def measure_distance(state, target, rng):
     true_distance = calculate_distance((state[0], state[1]), target)
-    noise = random.gauss(0, 0.01)       # simulating noisy sensor readings
+    noise = rng.gauss(0, 0.01)          # simulating noisy sensor readings
     return true_distance + noise
 
 ##################################################################
 # PARTICLE FILTER ################################################
 ##################################################################
 
-# calculate error of each particle and calculate weights
-def update_weights(particles, measured_distances, landmarks):
-    weights = []
-    for particle in particles:
-        # iterate through all particles
-        total_error = 0.0
-        for distance, landmark in zip(measured_distances, landmarks):
-            # exact distance, particles are hypotheses (virtual), no noisy sensor
-            expected_distance = calculate_distance((particle[0], particle[1]), landmark)
-            # difference between sensor reading and particle's calculated distance
-            error = abs(distance - expected_distance)
-            total_error += error
-
-        # safe division (non zero)
-        weight = 1.0 / (total_error + 0.001)
-        weights.append(weight)
-        
-    total_weight = sum(weights)
-    return [weight / total_weight for weight in weights]
+# calculate error of each particle and update its weight
+def update_weights(particles, measured_distances, landmarks, weights):
+    # for every particle (row) and landmark (column) at once:
+    # exact distance from the particle (a hypothesis, no noisy sensor) compared with the sensor reading,
+    # squared differences summed over landmarks -> one total error per particle
+    total_errors = measurement_errors(particles, landmarks, measured_distances)
 
-def resample(particles, weights):
-    # simplest method of resampling - ROULETTE WHEEL
-    return random.choices(particles, weights=weights, k=len(particles))
+    # likelihood of the readings if the particle were right: gaussian, exp(-0.5 * error / sigma^2)
+    # computed as its logarithm, exp of big errors would round to 0 for every particle
+    log_weights = gaussian_log_likelihood(total_errors, SIGMA_MEASUREMENT)
+
+    # new weight = old weight * likelihood, summing to 1 (log-sum-exp normalization)
+    return reweight(weights, log_weights).tolist()
 
-def get_estimate(particles):
-    # simplest method of getting estimated position - AVERAGE position of all particles
-    avg_x = sum(p[0] for p in particles) / len(particles)
-    avg_y = sum(p[1] for p in particles) / len(particles)
+def resample(particles, weights, rng):
+    # simplest method of resampling - ROULETTE WHEEL
+    return rng.choices(particles, weights=weights, k=len(particles))
+
+def get_estimate(particles, weights=None):
+    # simplest method of getting estimated position - (weighted) AVERAGE position of all particles
+    if weights is None:
+        weights = [1.0 / len(particles)] * len(particles)
+    avg_x = sum(w * p[0] for p, w in zip(particles, weights))
+    avg_y = sum(w * p[1] for p, w in zip(particles, weights))
     return avg_x, avg_y
 
 ##################################################################
@@ -108,21 +110,28 @@ def get_estimate(particles):
 ##################################################################
 
 if __name__ == "__main__":
+    # separate noise for robot, sensor and particles - same SEED gives the same run
+    rng_robot, rng_sensor, rng_particles = RandomStream(SEED).spawn(3)
+    
     # init state of robot
     state = (0.0, 0.0, 0.0) # x, y, phi
     
     # >>> robot initially knows where it is
     particles = [(0.0, 0.0, 0.0) for _ in range(NUM_PARTICLES)]
+    weights = [1.0 / NUM_PARTICLES] * NUM_PARTICLES
     state_estimated = state
 
     # # >>> robot doesnt know where it is
     # particles = []
     # for _ in range(NUM_PARTICLES):
-    #     rand_x = random.uniform(MAP_MIN_X, MAP_MAX_X)
-    #     rand_y = random.uniform(MAP_MIN_Y, MAP_MAX_Y)
-    #     rand_phi = random.uniform(0, 2 * np.pi)
+    #     rand_x = rng_particles.uniform(MAP_MIN_X, MAP_MAX_X)
+    #     rand_y = rng_particles.uniform(MAP_MIN_Y, MAP_MAX_Y)
+    #     rand_phi = rng_particles.uniform(0, 2 * np.pi)
     #     particles.append((rand_x, rand_y, rand_phi))
+    # weights = [1.0 / NUM_PARTICLES] * NUM_PARTICLES
     # state_estimated = get_estimate(particles)
+
+    resampler = SelectiveResampler(RESAMPLE_THRESHOLD)
     
     # plot config
     plt.figure(figsize=(16, 8))
@@ -154,22 +163,24 @@ if __name__ == "__main__":
     # iterate through all steps
     for step in range(NUM_STEPS):
         # move robot
-        state = move_robot(state)
+        state = move_robot(state, rng_robot)
 
         # move particle
-        particles = [move_particle(particle) for particle in particles]
+        particles = [move_particle(particle, rng_particles) for particle in particles]
 
         # measure distances
-        distances = [measure_distance(state, target) for target in LANDMARK_POSITIONS]
+        distances = [measure_distance(state, target, rng_sensor) for target in LANDMARK_POSITIONS]
 
         # calculate weights
-        weights = update_weights(particles, distances, LANDMARK_POSITIONS)
+        weights = update_weights(particles, distances, LANDMARK_POSITIONS, weights)
         
-        # resample particles
-        particles = resample(particles, weights)
+        # resample particles, but only once too few of them carry the weight
+        if resampler.needs_resampling(weights):
+            particles = resampler.run(resample, particles, weights, rng_particles)
+            weights = [1.0 / NUM_PARTICLES] * NUM_PARTICLES
 
         # calculate estimated position
-        state_estimated = get_estimate(particles)
+        state_estimated = get_estimate(particles, weights)
         
         # draw robot
         plt.plot(state[0], state[1], 'ro', markersize=8)
@@ -185,4 +196,5 @@ if __name__ == "__main__":
         # animate plot
         plt.pause(ANIM_PAUSE_S)
 
+    print(resampler.report())
     plt.show()
\ No newline at end of file
@@ -1,8 +1,19 @@
 import pygame
 import math
 import numpy as np
-import random
 import os
+import time
+import hashlib
+import json
+import multiprocessing
+import threading
+import collections
+
+from random_streams import RandomStream
+from particle_weights import gaussian_log_likelihood, normalize_log_weights, effective_sample_size
+from session_log import SessionRecorder
+from stage_profiler import StageProfiler
+from multiprocessing import shared_memory
 
 ##################################################################
 # CONSTANTS ######################################################
@@ -10,12 +21,21 @@ import os
 WINDOW_WIDTH = 800
 WINDOW_HEIGHT = 600
 FPS = 30
+SEED = None                     # set an int to get the same noise (and the same run) every time
+SESSION_LOG = None              # e.g. os.path.join(".", "drive.pflog") records keys, odometry and scans for particle_filter_replay.py
+MOTION_CHECK = "stop"           # "endpoint" tests only where a move ends, "stop" / "reject" test the whole swept path
+STOP_MARGIN = 0.01              # [px] gap left in front of a wall by the "stop" motion check
+FILTER_IN_BACKGROUND = True     # filter runs in its own thread, the window keeps FPS whatever the particle count
+PROFILE = False                 # time every stage, [p] shows p50/p95/max of the last 300 calls
+PROFILE_OUTPUT = None           # e.g. os.path.join(".", "profile.json") saves all calls as Chrome trace (.json) or CSV (.csv)
 
 COLOR_ROBOT = (0, 255, 0)
 COLOR_NOSE = (20, 20, 20)
 COLOR_PARTICLES = (0, 0, 255)
 COLOR_SENSOR_MEASUREMENTS = (255, 0, 0)
 COLOR_ESTIMATE = (255, 0, 0)
+COLOR_HEATMAP_LOW = (0, 0, 255)
+COLOR_HEATMAP_HIGH = (255, 255, 0)
 
 ##################################################################
 # CLASSES ########################################################
@@ -28,12 +48,47 @@ class Environment:
         self.map_surface_invisible = pygame.Surface((self.width, self.height))
         self.map_surface_invisible.fill((0, 0, 0, 255))
         
-        self.collision_grid = np.zeros((self.width, self.height), dtype=bool)
-        for x in range(self.width):
-            for y in range(self.height):
-                r, g, b, _ = self.map_surface.get_at((x, y))
-                if r < 128:
-                    self.collision_grid[x, y] = True
+        with open(map_filepath, "rb") as f:
+            self.map_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+        self.collision_grid = self._load_collision_grid()
+        self.free_cells = self._index_free_cells()
+        
+        self.max_obstacle_distance = 50.0
+        self.distance_field = self._compute_distance_field(self.collision_grid, self.max_obstacle_distance)
+        self.surface_distance_field = self._compute_surface_distance_field()
+    
+    def _load_collision_grid(self) -> np.ndarray:
+        root, _ = os.path.splitext(self.map_filepath)
+        mtime = int(os.path.getmtime(self.map_filepath))
+        cache_path = f"{root}.grid-{mtime}-{self.map_hash}.npy"
+        if os.path.exists(cache_path):
+            return np.load(cache_path)
+        
+        # threshold the whole image at once, dark pixels are walls (surfarray is indexed [x, y] too)
+        collision_grid = pygame.surfarray.array_red(self.map_surface) < 128
+        np.save(cache_path, collision_grid)
+        return collision_grid
+    
+    def _index_free_cells(self) -> np.ndarray:
+        # flat indices of all free pixels (ix * height + iy), random poses are drawn from here without rejection
+        return np.flatnonzero(~self.collision_grid).astype(np.int32 if self.collision_grid.size < 2 ** 31 else np.int64)
+    
+    def sample_free(self, num_samples: int, rng: RandomStream) -> tuple[np.ndarray, np.ndarray]:
+        # uniform over free space: uniformly chosen free pixel + uniform position inside it
+        cells = self.free_cells[rng.choice(len(self.free_cells), num_samples)]
+        return cells // self.height + rng.random(num_samples), cells % self.height + rng.random(num_samples)
+    
+    def sample_free_near(self, x: float, y: float, std: float, num_samples: int, rng: RandomStream) -> tuple[np.ndarray, np.ndarray]:
+        # gaussian around (x, y) cut to free space, resolved per pixel: free pixels within 4 std weighted by the density at their center
+        radius = int(math.ceil(4 * std))
+        ix, iy = np.meshgrid(np.arange(int(x) - radius, int(x) + radius + 1), np.arange(int(y) - radius, int(y) + radius + 1), indexing="ij")
+        free = ~self.is_collision_cells(ix, iy)
+        if not free.any():
+            raise ValueError(f"No free space around ({x}, {y})")
+        ix, iy = ix[free], iy[free]
+        density = np.exp(-((ix + 0.5 - x) ** 2 + (iy + 0.5 - y) ** 2) / (2 * std ** 2))
+        chosen = rng.choice(len(ix), num_samples, p=density / density.sum())
+        return ix[chosen] + rng.random(num_samples), iy[chosen] + rng.random(num_samples)
     
     def is_collision(self, x: float, y: float) -> bool:
         ix, iy = int(x), int(y)
@@ -41,52 +96,416 @@ class Environment:
             return True
         return self.collision_grid[ix, iy]
     
+    def is_collision_batch(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        return self.is_collision_cells(np.asarray(xs).astype(int), np.asarray(ys).astype(int))
+    
+    def is_collision_cells(self, ix: np.ndarray, iy: np.ndarray) -> np.ndarray:
+        inside = (ix >= 0) & (ix < self.width) & (iy >= 0) & (iy < self.height)
+        collision = np.ones(ix.shape, dtype=bool)
+        collision[inside] = self.collision_grid[ix[inside], iy[inside]]
+        return collision
+    
+    @classmethod
+    def from_grids(cls, collision_grid: np.ndarray, distance_field: np.ndarray, max_obstacle_distance: float,
+                   surface_distance_field: np.ndarray = None):
+        # map without an image, enough for collision checks, ray casting and scoring (e.g. in worker processes)
+        # it can not sample free space (no free_cells index), only the Environment the particles come from does
+        env = cls.__new__(cls)
+        env.map_filepath = None
+        env.width, env.height = collision_grid.shape
+        env.collision_grid = collision_grid
+        env.free_cells = None
+        env.max_obstacle_distance = max_obstacle_distance
+        env.distance_field = distance_field
+        # given fields are used as they are (shared memory), a missing one is computed
+        env.surface_distance_field = surface_distance_field if surface_distance_field is not None else env._compute_surface_distance_field()
+        return env
+    
+    def cast_rays_python(self, xs: np.ndarray, ys: np.ndarray, angles: np.ndarray, max_range: float, step: float) -> np.ndarray:
+        # reference implementation, one ray and one step at a time
+        distances = np.empty(angles.shape)
+        for i, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+            for j, angle in enumerate(angles[i].tolist()):
+                current_distance = 0.0
+                while current_distance <= max_range:
+                    check_x = x + current_distance * math.cos(angle)
+                    check_y = y + current_distance * math.sin(angle)
+                    if self.is_collision(check_x, check_y):
+                        break
+                    
+                    current_distance += step
+                distances[i, j] = current_distance
+        return distances
+    
+    def cast_rays_march(self, xs: np.ndarray, ys: np.ndarray, angles: np.ndarray, max_range: float, step: float) -> np.ndarray:
+        # same fixed-step marching as the scalar loop, all rays at once
+        xs, ys, angles = np.broadcast_arrays(xs, ys, angles)
+        shape = angles.shape
+        xs, ys, angles = xs.ravel(), ys.ravel(), angles.ravel()
+        
+        steps = np.arange(int(max_range // step) + 1) * step
+        distances = np.empty(len(angles))
+        chunk = max(1, 2_000_000 // len(steps))
+        for i in range(0, len(angles), chunk):
+            sl = slice(i, i + chunk)
+            cos_a = np.cos(angles[sl])[:, None]
+            sin_a = np.sin(angles[sl])[:, None]
+            hits = self.is_collision_batch(xs[sl, None] + steps * cos_a, ys[sl, None] + steps * sin_a)
+            first_hit = np.argmax(hits, axis=1)
+            # without a hit the loop stops at the first step beyond max range
+            distances[sl] = np.where(hits.any(axis=1), steps[first_hit], len(steps) * step)
+        return distances.reshape(shape)
+    
+    def cast_rays_dda(self, xs: np.ndarray, ys: np.ndarray, angles: np.ndarray, max_range: float) -> np.ndarray:
+        # exact grid traversal (Amanatides & Woo), every ray visits each crossed cell once
+        # max_range can differ per ray (e.g. swept motion checks)
+        xs, ys, angles, max_range = np.broadcast_arrays(xs, ys, angles, np.asarray(max_range, dtype=float))
+        shape = angles.shape
+        xs, ys, angles, max_range = xs.ravel(), ys.ravel(), angles.ravel(), max_range.ravel()
+        
+        dir_x = np.cos(angles)
+        dir_y = np.sin(angles)
+        cell_x = np.floor(xs).astype(int)
+        cell_y = np.floor(ys).astype(int)
+        step_x = np.where(dir_x >= 0, 1, -1)
+        step_y = np.where(dir_y >= 0, 1, -1)
+        
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta_x = np.where(dir_x != 0, np.abs(1.0 / dir_x), np.inf)
+            delta_y = np.where(dir_y != 0, np.abs(1.0 / dir_y), np.inf)
+            t_max_x = np.where(dir_x != 0, np.where(dir_x >= 0, cell_x + 1 - xs, xs - cell_x) * delta_x, np.inf)
+            t_max_y = np.where(dir_y != 0, np.where(dir_y >= 0, cell_y + 1 - ys, ys - cell_y) * delta_y, np.inf)
+        
+        distances = max_range.copy()
+        distances[self.is_collision_cells(cell_x, cell_y)] = 0.0
+        active = np.flatnonzero(distances > 0.0)
+        while len(active) > 0:
+            go_x = t_max_x[active] < t_max_y[active]
+            go_y = ~go_x
+            t = np.where(go_x, t_max_x[active], t_max_y[active])
+            
+            ix, iy = active[go_x], active[go_y]
+            cell_x[ix] += step_x[ix]
+            t_max_x[ix] += delta_x[ix]
+            cell_y[iy] += step_y[iy]
+            t_max_y[iy] += delta_y[iy]
+            
+            in_range = t <= max_range[active]
+            hit = in_range & self.is_collision_cells(cell_x[active], cell_y[active])
+            distances[active[hit]] = t[hit]
+            active = active[in_range & ~hit]
+        return distances.reshape(shape)
+    
+    def cast_rays_crossings(self, xs: np.ndarray, ys: np.ndarray, angles: np.ndarray, max_range: float) -> np.ndarray:
+        # same exact result as cast_rays_dda, but all grid line crossings are checked at once
+        # no python loop over cells -> faster for a few hundred rays (one lidar scan) or short rays, slower for many long ones
+        xs, ys, angles, max_range = np.broadcast_arrays(xs, ys, angles, np.asarray(max_range, dtype=float))
+        shape = angles.shape
+        xs, ys, angles, max_range = xs.ravel(), ys.ravel(), angles.ravel(), max_range.ravel()
+        
+        dir_x = np.cos(angles)
+        dir_y = np.sin(angles)
+        cell_x = np.floor(xs).astype(int)
+        cell_y = np.floor(ys).astype(int)
+        step_x = np.where(dir_x >= 0, 1, -1)
+        step_y = np.where(dir_y >= 0, 1, -1)
+        
+        # rays parallel to an axis never cross its grid lines, a huge finite t keeps the math NaN free
+        never = 1e12
+        with np.errstate(divide="ignore"):
+            delta_x = np.where(dir_x != 0, np.abs(1.0 / dir_x), never)
+            delta_y = np.where(dir_y != 0, np.abs(1.0 / dir_y), never)
+        first_x = np.where(dir_x != 0, np.where(dir_x >= 0, cell_x + 1 - xs, xs - cell_x) * delta_x, never)
+        first_y = np.where(dir_y != 0, np.where(dir_y >= 0, cell_y + 1 - ys, ys - cell_y) * delta_y, never)
+        
+        k = np.arange(int(math.ceil(max_range.max(initial=0.0))) + 1)
+        distances = max_range.copy()
+        chunk = max(1, 1_000_000 // len(k))
+        for i in range(0, len(angles), chunk):
+            sl = slice(i, i + chunk)
+            limit = max_range[sl, None]
+            t_x = np.minimum(first_x[sl, None] + k * delta_x[sl, None], limit + 1)
+            t_y = np.minimum(first_y[sl, None] + k * delta_y[sl, None], limit + 1)
+            # crossing the k-th vertical line enters the next column, the row follows from the crossing point
+            hit_x = self._first_hit(t_x, cell_x[sl, None] + step_x[sl, None] * (k + 1), np.floor(ys[sl, None] + t_x * dir_y[sl, None]).astype(int), limit)
+            hit_y = self._first_hit(t_y, np.floor(xs[sl, None] + t_y * dir_x[sl, None]).astype(int), cell_y[sl, None] + step_y[sl, None] * (k + 1), limit)
+            distances[sl] = np.minimum(distances[sl], np.minimum(hit_x, hit_y))
+        distances[self.is_collision_cells(cell_x, cell_y)] = 0.0
+        return distances.reshape(shape)
+    
+    def _first_hit(self, t: np.ndarray, ix: np.ndarray, iy: np.ndarray, max_range: np.ndarray) -> np.ndarray:
+        hits = (t <= max_range) & self.is_collision_cells(ix, iy)
+        first = np.argmax(hits, axis=1)
+        return np.where(hits.any(axis=1), t[np.arange(len(t)), first], np.inf)
+    
+    def sweep_batch(self, xs: np.ndarray, ys: np.ndarray, new_xs: np.ndarray, new_ys: np.ndarray) -> np.ndarray:
+        # how far along each straight move (x, y) -> (new_x, new_y) we get before entering a wall
+        # 1.0 = the whole segment is free, checks every crossed cell so thin walls can not be skipped
+        dx, dy = new_xs - xs, new_ys - ys
+        lengths = np.hypot(dx, dy)
+        
+        # a point is at most sqrt(2) from the corner of its cell, so a move shorter than the cell's
+        # distance to the nearest wall minus sqrt(2) can not reach it - only moves near walls are traversed
+        ix, iy = np.floor(xs).astype(int), np.floor(ys).astype(int)
+        inside = (ix >= 0) & (ix < self.width) & (iy >= 0) & (iy < self.height)
+        clearance = np.zeros(len(lengths))
+        clearance[inside] = self.distance_field[ix[inside], iy[inside]]
+        near = np.flatnonzero(lengths + math.sqrt(2) > clearance)
+        
+        free = np.ones(len(lengths))
+        if len(near) > 0:
+            free_lengths = self.cast_rays_dda(xs[near], ys[near], np.arctan2(dy[near], dx[near]), lengths[near])
+            free[near] = np.where(free_lengths >= lengths[near], 1.0, free_lengths / np.maximum(lengths[near], 1e-12))
+        return free
+    
+    def sweep(self, x: float, y: float, new_x: float, new_y: float) -> float:
+        # sweep_batch for a single move (the robot), a plain loop over the crossed cells beats numpy overhead here
+        dx, dy = new_x - x, new_y - y
+        length = math.hypot(dx, dy)
+        cell_x, cell_y = math.floor(x), math.floor(y)
+        if length == 0.0:
+            return 1.0
+        if self.is_collision(cell_x, cell_y):
+            return 0.0
+        
+        step_x, step_y = (1 if dx >= 0 else -1), (1 if dy >= 0 else -1)
+        delta_x = length / abs(dx) if dx != 0 else math.inf
+        delta_y = length / abs(dy) if dy != 0 else math.inf
+        t_max_x = ((cell_x + 1 - x) if dx >= 0 else (x - cell_x)) * delta_x if dx != 0 else math.inf
+        t_max_y = ((cell_y + 1 - y) if dy >= 0 else (y - cell_y)) * delta_y if dy != 0 else math.inf
+        while True:
+            if t_max_x < t_max_y:
+                t = t_max_x
+                cell_x += step_x
+                t_max_x += delta_x
+            else:
+                t = t_max_y
+                cell_y += step_y
+                t_max_y += delta_y
+            if t > length:
+                return 1.0
+            if self.is_collision(cell_x, cell_y):
+                return t / length
+    
+    def surface_distance_batch(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        ix = np.asarray(xs).astype(int)
+        iy = np.asarray(ys).astype(int)
+        inside = (ix >= 0) & (ix < self.width) & (iy >= 0) & (iy < self.height)
+        # endpoints beyond the map are as unlikely as possible, not as good as a wall hit
+        distances = np.full(ix.shape, self.max_obstacle_distance)
+        distances[inside] = self.surface_distance_field[ix[inside], iy[inside]]
+        return distances
+    
+    def _compute_surface_distance_field(self) -> np.ndarray:
+        # distance to the nearest wall surface: free cells to the nearest wall, wall cells to the nearest free cell
+        # a beam ending deep inside a thick wall explains the scan as badly as one ending in open space,
+        # with the plain distance field (0 everywhere inside walls) such poses would score perfectly
+        depth = self._compute_distance_field(~self.collision_grid, self.max_obstacle_distance, border=False)
+        return np.minimum(self.distance_field + depth, self.max_obstacle_distance)
+    
+    def _compute_distance_field(self, obstacles: np.ndarray, max_distance: float, border: bool = True) -> np.ndarray:
+        # euclidean distance to the nearest True cell of obstacles truncated at max_distance,
+        # with border=True the map border counts as an obstacle
+        grid = np.pad(obstacles, 1, constant_values=border)
+        size_y = grid.shape[1]
+        
+        # 1) distance to the nearest obstacle in the same column
+        idx = np.arange(size_y)
+        prev_obstacle = np.maximum.accumulate(np.where(grid, idx, -size_y), axis=1)
+        next_obstacle = np.minimum.accumulate(np.where(grid, idx, 2 * size_y)[:, ::-1], axis=1)[:, ::-1]
+        column_distance = np.minimum(idx - prev_obstacle, next_obstacle - idx)
+        column_distance = np.minimum(column_distance, max_distance + 1).astype(float)
+        
+        # 2) combine columns, only the ones closer than max_distance can matter
+        squared = column_distance ** 2
+        best = squared.copy()
+        for dx in range(1, int(max_distance) + 1):
+            np.minimum(best[dx:], squared[:-dx] + dx ** 2, out=best[dx:])
+            np.minimum(best[:-dx], squared[dx:] + dx ** 2, out=best[:-dx])
+        
+        return np.minimum(np.sqrt(best), max_distance)[1:-1, 1:-1]
+    
     def draw(self, screen: pygame.SurfaceType, is_map_visible:bool=True) -> None:
         if is_map_visible:
             screen.blit(self.map_surface, (0, 0))
             return None
         screen.blit(self.map_surface_invisible, (0, 0))
 
+##################################################################
+class PackedOccupancyGrid:
+    # 1 bit per cell in square tiles, memory-mapped so only touched tiles are paged in
+    def __init__(self, filepath: str):
+        with open(filepath + ".json") as f:
+            header = json.load(f)
+        self.width = header["width"]
+        self.height = header["height"]
+        self.tile_size = header["tile_size"]
+        # tiles[tile_x, tile_y, local_x, local_y // 8], bits packed along y
+        self.tiles = np.load(filepath, mmap_mode="r")
+    
+    @staticmethod
+    def save(collision_grid: np.ndarray, filepath: str, tile_size: int = 64) -> None:
+        # collision_grid may itself be a memmap, it is read one strip of tiles at a time
+        if tile_size % 8 != 0:
+            raise ValueError("Tile size must be a multiple of 8")
+        width, height = collision_grid.shape
+        tiles_x = math.ceil(width / tile_size)
+        tiles_y = math.ceil(height / tile_size)
+        tiles = np.lib.format.open_memmap(filepath, mode="w+", dtype=np.uint8, shape=(tiles_x, tiles_y, tile_size, tile_size // 8))
+        for tx in range(tiles_x):
+            strip = np.ones((tile_size, tiles_y * tile_size), dtype=bool)
+            block = collision_grid[tx * tile_size:(tx + 1) * tile_size]
+            strip[:block.shape[0], :height] = block
+            packed = np.packbits(strip, axis=1).reshape(tile_size, tiles_y, tile_size // 8)
+            tiles[tx] = packed.transpose(1, 0, 2)
+        tiles.flush()
+        with open(filepath + ".json", "w") as f:
+            json.dump({"width": width, "height": height, "tile_size": tile_size}, f)
+    
+    def is_collision(self, x: float, y: float) -> bool:
+        ix, iy = int(x), int(y)
+        if ix < 0 or ix >= self.width or iy < 0 or iy >= self.height:
+            return True
+        t = self.tile_size
+        byte = self.tiles[ix // t, iy // t, ix % t, (iy % t) // 8]
+        return bool((byte >> (7 - iy % 8)) & 1)
+    
+    def is_collision_batch(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        return self.is_collision_cells(np.asarray(xs).astype(int), np.asarray(ys).astype(int))
+    
+    def is_collision_cells(self, ix: np.ndarray, iy: np.ndarray) -> np.ndarray:
+        inside = (ix >= 0) & (ix < self.width) & (iy >= 0) & (iy < self.height)
+        ix, iy = ix[inside], iy[inside]
+        t = self.tile_size
+        byte = self.tiles[ix // t, iy // t, ix % t, (iy % t) // 8]
+        collision = np.ones(inside.shape, dtype=bool)
+        collision[inside] = (byte >> (7 - iy % 8)) & 1
+        return collision
+
 ##################################################################
 class Sensor:
-    def __init__(self, fov_degrees: int, num_rays: int, noise_std: float, max_range: float):
+    def __init__(self, fov_degrees: int, num_rays: int, noise_std: float, max_range: float, rng: RandomStream = None):
         self.fov = math.radians(float(fov_degrees))
         self.num_rays = num_rays
         self.noise_std = noise_std
         self.max_range = max_range
         self.last_scan = []
         
-        self.__scan_step = 2.0
+        self.__rng = rng if rng is not None else RandomStream()
         
         if self.num_rays > 1:
             self.angle_increment = self.fov / (self.num_rays - 1)
         else:
             self.angle_increment = 0.0
             self.fov = 0.0
+        self.relative_angles = -(self.fov / 2.0) + np.arange(self.num_rays) * self.angle_increment
+        
+        # exact ranges of the last cast, reused while the robot stands still
+        self.__last_pose = None
+        self.__last_distances = None
+        self.__last_hits = None
             
-    def sense(self, x: float, y: float, theta: float, env: Environment) -> None:
-        measurements = []
-        start_angle = -(self.fov / 2.0)
-        for i in range(self.num_rays):
-            relative_angle = start_angle + (i * self.angle_increment)
-            global_angle = theta + relative_angle
-            distance = 0
-            while distance <= self.max_range:
-                check_x = x + distance * math.cos(global_angle)
-                check_y = y + distance * math.sin(global_angle)
-                
-                if env.is_collision(check_x, check_y):
-                    noisy_distance = distance + random.gauss(0, self.noise_std)
-                    measurements.append((noisy_distance, relative_angle))
-                    break
-                
-                distance += self.__scan_step
+    def sense(self, x: float, y: float, theta: float, env: Environment) -> list[tuple[float, float]]:
+        pose = (x, y, theta, id(env))
+        if pose != self.__last_pose:
+            # all beams at once with exact grid traversal
+            distances = env.cast_rays_crossings(x, y, theta + self.relative_angles, self.max_range)
+            self.__last_hits = distances < self.max_range
+            self.__last_distances = distances[self.__last_hits]
+            self.__last_pose = pose
+        
+        # fresh noise every scan, only beams that hit something return a measurement
+        noisy_distances = self.__last_distances + self.__rng.normal(0, self.noise_std, len(self.__last_distances))
+        return list(zip(noisy_distances.tolist(), self.relative_angles[self.__last_hits].tolist()))
+
+##################################################################
+class RangeTable:
+    # expected ray length for every (cell, beam angle) of a static map, built once and cached on disk
+    def __init__(self, env: Environment, max_range: float, num_angles: int = 90, cell_size: int = 4):
+        self.max_range = max_range
+        self.num_angles = num_angles
+        self.cell_size = cell_size
+        self.cache_path = self._get_cache_path(env)
+        
+        if os.path.exists(self.cache_path):
+            print(f"[RangeTable] loading {self.cache_path}")
+        else:
+            np.save(self.cache_path, self._build(env))
+        self.ranges = np.load(self.cache_path, mmap_mode="r")
+        print(f"[RangeTable] {self.ranges.shape[0]}x{self.ranges.shape[1]} cells x {self.num_angles} angles, {self.ranges.nbytes / 1e6:.1f} MB")
+    
+    def _get_cache_path(self, env: Environment) -> str:
+        root, _ = os.path.splitext(env.map_filepath)
+        return f"{root}.ranges-{env.map_hash}-a{self.num_angles}-c{self.cell_size}-r{self.max_range:g}.npy"
+    
+    def _build(self, env: Environment) -> np.ndarray:
+        cells_x = math.ceil(env.width / self.cell_size)
+        cells_y = math.ceil(env.height / self.cell_size)
+        dtype = np.uint8 if self.max_range <= np.iinfo(np.uint8).max else np.uint16
+        ranges = np.zeros((cells_x, cells_y, self.num_angles), dtype=dtype)
+        
+        # rays start from cell centers, cells with an occupied center keep range 0
+        ix, iy = np.meshgrid(np.arange(cells_x), np.arange(cells_y), indexing="ij")
+        cx = (ix + 0.5) * self.cell_size
+        cy = (iy + 0.5) * self.cell_size
+        free = ~env.is_collision_batch(cx, cy)
+        ix, iy, cx, cy = ix[free], iy[free], cx[free], cy[free]
         
-        return measurements
+        start = time.perf_counter()
+        for a in range(self.num_angles):
+            angle = a * 2 * math.pi / self.num_angles
+            distances = env.cast_rays_dda(cx, cy, np.full(len(cx), angle), self.max_range)
+            ranges[ix, iy, a] = np.rint(distances)
+            print(f"\r[RangeTable] building {a + 1}/{self.num_angles} angles for {len(cx)} free cells", end="")
+        print(f" - done in {time.perf_counter() - start:.1f} s")
+        return ranges
+    
+    def lookup(self, xs: np.ndarray, ys: np.ndarray, angles: np.ndarray) -> np.ndarray:
+        xs, ys, angles = np.broadcast_arrays(xs, ys, angles)
+        ix = np.floor(xs / self.cell_size).astype(int)
+        iy = np.floor(ys / self.cell_size).astype(int)
+        ia = np.rint(angles * self.num_angles / (2 * math.pi)).astype(int) % self.num_angles
+        
+        # poses outside the map behave like poses inside a wall
+        inside = (ix >= 0) & (ix < self.ranges.shape[0]) & (iy >= 0) & (iy < self.ranges.shape[1])
+        distances = np.zeros(angles.shape)
+        distances[inside] = self.ranges[ix[inside], iy[inside], ia[inside]]
+        return distances
+
+##################################################################
+class OccupancyPyramid:
+    # the map at 1, 1/2, 1/4, ... resolution, level k has cells of 2^k x 2^k pixels
+    # a coarse cell is occupied if any of its pixels is -> walls never disappear, only get thicker
+    def __init__(self, env: Environment, num_levels: int = 3):
+        self.levels = [env]
+        collision_grid, distance_field = env.collision_grid, env.distance_field
+        max_obstacle_distance = env.max_obstacle_distance
+        for _ in range(1, num_levels):
+            # pad to even size (outside of the map is a wall), then pool 2x2 blocks
+            w, h = collision_grid.shape
+            collision_grid = np.pad(collision_grid, ((0, w % 2), (0, h % 2)), constant_values=True)
+            collision_grid = collision_grid.reshape(-1, 2, collision_grid.shape[1] // 2, 2).any(axis=(1, 3))
+            # distances are kept in cells of the level, the nearest pixel of a block is taken
+            distance_field = np.pad(distance_field, ((0, w % 2), (0, h % 2)), constant_values=0.0)
+            distance_field = distance_field.reshape(-1, 2, distance_field.shape[1] // 2, 2).min(axis=(1, 3)) / 2
+            max_obstacle_distance /= 2
+            self.levels.append(Environment.from_grids(collision_grid, distance_field, max_obstacle_distance))
+    
+    def squared_errors(self, level: int, particles: np.ndarray, real_distances: np.ndarray, phis: np.ndarray, max_range: float, scan_step: float,
+                       ray_casting: str = "march", measurement_model: str = "beam") -> np.ndarray:
+        # same as compute_squared_errors, but rays march over the coarse cells (scan_step cells at a time)
+        # everything is scaled down to the level and the result back to pixels^2
+        scale = 2 ** level
+        scaled = particles.copy()
+        scaled[:, :2] /= scale
+        errors = compute_squared_errors(self.levels[level], scaled, real_distances / scale, phis, max_range / scale, scan_step, ray_casting, measurement_model)
+        return errors * scale ** 2
 
 ##################################################################
 class Robot:
-    def __init__(self, x: float, y: float, theta: float, sensor: Sensor):
+    def __init__(self, x: float, y: float, theta: float, sensor: Sensor, motion_check: str = "endpoint"):
+        if motion_check not in ("endpoint", "stop"):
+            raise ValueError(f"Unknown motion check '{motion_check}' for the robot")
         self.x = x
         self.y = y
         self.theta = theta
@@ -97,23 +516,11 @@ class Robot:
         
         self.max_v = 120.0
         self.max_w = 4.0
-        
+        # "endpoint": move only if the target is free, "stop": drive along the swept path up to the wall
+        self.motion_check = motion_check
         
     def update(self, keys: pygame.constants, dt: float, env: Environment) -> tuple[float, float]:
-        cmd_v = 0.0
-        cmd_w = 0.0
-        
-        # forward/backward
-        if keys[pygame.K_UP] or keys[pygame.K_w]:
-            cmd_v = self.max_v
-        if keys[pygame.K_DOWN] or keys[pygame.K_s]:
-            cmd_v = -self.max_v / 2.0
-        
-        # left/right
-        if keys[pygame.K_LEFT] or keys[pygame.K_a]:
-            cmd_w = -self.max_w
-        if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
-            cmd_w = self.max_w
+        cmd_v, cmd_w = keys_to_command(keys, self.max_v, self.max_w)
         
         real_v = 0.0
         real_w = cmd_w
@@ -123,7 +530,15 @@ class Robot:
         next_y = self.y + cmd_v * math.sin(next_theta) * dt
         
         self.theta = next_theta
-        if not env.is_collision(next_x, next_y):
+        if self.motion_check == "stop":
+            free = env.sweep(self.x, self.y, next_x, next_y)
+            if free < 1.0:
+                # stop just before the wall, odometry reports the distance really driven
+                free = max(free - STOP_MARGIN / max(abs(cmd_v) * dt, 1e-12), 0.0)
+            self.x += free * (next_x - self.x)
+            self.y += free * (next_y - self.y)
+            real_v = cmd_v * free
+        elif not env.is_collision(next_x, next_y):
             self.x = next_x
             self.y = next_y
             real_v = cmd_v
@@ -142,31 +557,114 @@ class Robot:
         if not sensor_visible:
             return
         
-        for d, phi in self.last_scan:
-            x = self.x + d * math.cos(self.theta + phi)
-            y = self.y + d * math.sin(self.theta + phi)
-            pygame.draw.circle(screen, COLOR_SENSOR_MEASUREMENTS, (int(x), int(y)), 2)
+        if not self.last_scan:
+            return
+        d, phi = np.array(self.last_scan).T
+        x = self.x + d * np.cos(self.theta + phi)
+        y = self.y + d * np.sin(self.theta + phi)
+        draw_points(screen, x, y, COLOR_SENSOR_MEASUREMENTS, 2)
 
 ##################################################################
 class ParticleFilter:
-    def __init__(self, num_particles: int, env: Environment, start_position = None):
+    def __init__(self, num_particles: int, env: Environment, start_position = None,
+                 ray_casting: str = "march", range_table: RangeTable = None, measurement_model: str = "beam",
+                 num_workers: int = 1, resampling: str = "systematic",
+                 adaptive: bool = False, min_particles: int = 100, max_particles: int = 5000,
+                 pyramid_levels: int = 1, motion_check: str = "endpoint", render_mode: str = "points", render_every: int = 1, rng: RandomStream = None):
+        if ray_casting not in ("python", "march", "dda"):
+            raise ValueError(f"Unknown ray casting method '{ray_casting}'")
+        if measurement_model not in ("beam", "likelihood_field"):
+            raise ValueError(f"Unknown measurement model '{measurement_model}'")
+        if resampling not in RESAMPLING_METHODS:
+            raise ValueError(f"Unknown resampling method '{resampling}'")
+        if motion_check not in ("endpoint", "stop", "reject"):
+            raise ValueError(f"Unknown motion check '{motion_check}'")
+        if render_mode not in ("points", "heatmap"):
+            raise ValueError(f"Unknown render mode '{render_mode}'")
+        
         self.num_particles = num_particles
-        self.particles = []
+        self.ray_casting = ray_casting
+        self.range_table = range_table
+        self.measurement_model = measurement_model
+        self.num_workers = num_workers
+        self.resampling = resampling
+        self.motion_check = motion_check
+        self.render_mode = render_mode
+        self.render_every = render_every
+        self.adaptive = adaptive
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        # coarse-to-fine scoring of a spread out particle set, 1 level = always full resolution
+        self.pyramid = OccupancyPyramid(env, pyramid_levels) if pyramid_levels > 1 else None
+        if adaptive and start_position is None:
+            # global localization needs as many particles as we allow
+            num_particles = max_particles
+            self.num_particles = num_particles
+        # structure of arrays: one row (x, y, theta) per particle
+        self.particles = np.zeros((num_particles, 3))
+        # particles whose path went through a wall since the last resample ("reject" motion check)
+        self.rejected = None
         
         self.x_estimated = 0.0
         self.y_estimated = 0.0
         self.theta_estimated = 0.0
         
         self.__scan_step = 4.0
-        self.__variance = 200.0
+        self.__measurement_std = 10.0   # [px] per beam, same as the former exp(-e^2 / 200)
         
         self.__ratio_kept = 0.2
         self.__ratio_generated = 0.1
         self.__ratio_estimated = 0.1
         
+        # after a reset, the first updates score everyone on the coarsest level and refine only
+        # the best __pyramid_survivors of them on each finer level
+        self.__pyramid_survivors = 0.5
+        self.__pyramid_updates = 10
+        self.__coarse_updates_left = 0 if start_position is not None else self.__pyramid_updates
+        
         self.__estimate_line_thickness = 2
         self.__particle_size = 1
+        self.__heatmap_cell_size = 4
+        
+        # particles are rendered into their own layer, redrawn only every render_every frames
+        self.__particle_layer = None
+        self.__frames_since_render = 0
+        
+        self.__rng = rng if rng is not None else RandomStream()
+        
+        # KLD-sampling: bin size (x, y, theta) and bound on the error with probability given by z
+        self.__kld_bin_size = np.array([20.0, 20.0, math.radians(20.0)])
+        self.__kld_epsilon = 0.05
+        self.__kld_z = 2.33
+        # the set only shrinks once the weights are not degenerate, not during the first updates after a reset
+        # and by at most __kld_max_shrink per resample, one lucky frame can not throw away the true pose
+        self.__kld_min_ess_ratio = 0.02
+        self.__kld_warmup_updates = 30
+        self.__kld_max_shrink = 0.2
+        self.__kld_updates_left = 0 if start_position is not None else self.__kld_warmup_updates
+        
+        # seconds spent in the last call of every filter step
+        self.step_times = {"predict": 0.0, "update_weights": 0.0, "resample": 0.0}
+        
+        self.__pool = None
+        self.__shared_memory = []
+        if num_workers > 1:
+            self._start_workers(env)
         
+        self._set_num_particles(num_particles)
+        
+        self.weights = np.full(num_particles, 1.0 / num_particles)
+        self.ess = float(num_particles)
+        if start_position is not None:
+            init_x, init_y, init_theta = start_position
+            x, y = env.sample_free_near(init_x, init_y, 1.0, num_particles, self.__rng)
+            theta = self.__rng.normal(init_theta, 0.1, num_particles)
+            self.particles = np.column_stack((x, y, theta))
+        else:
+            self.particles = self._generate_random_particles(num_particles, env)
+                    
+    def _set_num_particles(self, num_particles: int) -> None:
+        self.num_particles = num_particles
         self.num_kept = int(self.num_particles * self.__ratio_kept)
         self.num_generated = int(self.num_particles * self.__ratio_generated)
         self.num_choosed = int(self.num_particles - self.num_kept - self.num_generated)
@@ -174,132 +672,497 @@ class ParticleFilter:
         
         if sum([self.num_kept, self.num_generated, self.num_choosed]) - self.num_particles != 0:
             raise ValueError("Not 100")
+    
+    @property
+    def frame_time(self) -> float:
+        return sum(self.step_times.values())
+    
+    def predict(self, input_v: float, input_w: float, dt: float, env: Environment):
+        start = time.perf_counter()
+        n = len(self.particles)
+        noisy_v = input_v + self.__rng.normal(0, 0.1, n)
+        noisy_w = input_w + self.__rng.normal(0, 0.05, n)
         
-        self.weights = [1.0 / num_particles] * num_particles
-        if start_position is not None:
-            init_x, init_y, init_theta = start_position
-            while len(self.particles) != num_particles:
-                x = random.gauss(init_x, 1)
-                y = random.uniform(init_y, 1)
-                if not env.is_collision(x, y):
-                    theta = random.gauss(init_theta, 0.1)
-                    self.particles.append((x, y, theta))
+        x, y, theta = self.particles.T
+        new_theta = theta + noisy_w * dt
+        new_x = x + noisy_v * dt * np.cos(new_theta)
+        new_y = y + noisy_v * dt * np.sin(new_theta)
+        
+        if self.motion_check == "endpoint":
+            # particles hitting the wall only turn, same as the robot
+            collision = env.is_collision_batch(new_x, new_y)
+            self.particles = np.column_stack((
+                np.where(collision, x, new_x),
+                np.where(collision, y, new_y),
+                new_theta,
+            ))
         else:
-            self.particles = self._generate_random_particles(num_particles, env)
-                    
-    def predict(self, input_v: float, input_w: float, dt: float, env: Environment):
-        new_particles = []
-        for x, y, theta in self.particles:
-            noisy_v = input_v + random.gauss(0, 0.1)
-            noisy_w = input_w + random.gauss(0, 0.05)
-            
-            new_theta = theta + noisy_w * dt
-            new_x = x + noisy_v * dt * math.cos(new_theta)
-            new_y = y + noisy_v * dt * math.sin(new_theta)
-            
-            if not env.is_collision(new_x, new_y):
-                new_particles.append((new_x, new_y, new_theta))
+            free = env.sweep_batch(x, y, new_x, new_y)
+            blocked = free < 1.0
+            if self.motion_check == "stop":
+                # slide along the swept path up to the wall
+                free[blocked] = np.maximum(free[blocked] - STOP_MARGIN / np.maximum(np.abs(noisy_v[blocked]) * dt, 1e-12), 0.0)
+                new_x = x + free * (new_x - x)
+                new_y = y + free * (new_y - y)
             else:
-                new_particles.append((x, y, new_theta))
-        
-        self.particles = new_particles
+                # a particle that drove through a wall is a wrong hypothesis, it gets no weight and is replaced in resample
+                new_x = np.where(blocked, x, new_x)
+                new_y = np.where(blocked, y, new_y)
+                self.rejected = blocked if self.rejected is None else self.rejected | blocked
+            self.particles = np.column_stack((new_x, new_y, new_theta))
+        self.step_times["predict"] = time.perf_counter() - start
     
     def update_weights(self, real_scan, sensor: Sensor, env: Environment) -> None:
         if not real_scan:
+            self.step_times["update_weights"] = 0.0
             return
         
-        new_weights = []
+        start = time.perf_counter()
+        downsampled_scan = np.array(real_scan[::5])
+        real_distances, phis = downsampled_scan.T
         
-        downsampled_scan = real_scan[::5]
-        
-        for x, y, theta in self.particles:
-            score = 1.0
-            particle_scan = []
-            
-            for real_distance, phi in downsampled_scan:
-                current_distance = 0.0
-                while current_distance <= sensor.max_range:
-                    check_x = x + current_distance * math.cos(theta + phi)
-                    check_y = y + current_distance * math.sin(theta + phi)
-                    if env.is_collision(check_x, check_y):
-                        particle_scan.append((current_distance, phi))
-                        break
-                    
-                    current_distance += self.__scan_step
-            
-                error = abs(real_distance - current_distance)
-                score *= math.exp(-(error ** 2) / self.__variance)
-                
-            new_weights.append(score)
-            
-        total = sum(new_weights)
-        if total > 0:
-            self.weights = [w / total for w in new_weights]
+        if self.pyramid is not None and self.range_table is None and self.__coarse_updates_left > 0:
+            squared_errors = self._coarse_to_fine_errors(real_distances, phis, sensor, env)
+            self.__coarse_updates_left -= 1
         else:
-            self.weights = [1.0 / self.num_particles] * self.num_particles
+            squared_errors = self._squared_errors(self.particles, real_distances, phis, sensor, env)
+        
+        # product of gaussians over beams, as a sum of logs it can not underflow to 0 with many beams
+        log_weights = gaussian_log_likelihood(squared_errors, self.__measurement_std)
+        if self.rejected is not None:
+            log_weights[self.rejected] = -np.inf
+        self.weights = normalize_log_weights(log_weights)
+        self.ess = float(effective_sample_size(self.weights))
+        self.step_times["update_weights"] = time.perf_counter() - start
+    
+    def _squared_errors(self, particles: np.ndarray, real_distances: np.ndarray, phis: np.ndarray, sensor: Sensor, env: Environment) -> np.ndarray:
+        if self.__pool is not None and self.range_table is None:
+            # every worker scores one chunk of particles against the shared map
+            chunks = np.array_split(particles, self.num_workers)
+            jobs = [(chunk, real_distances, phis, sensor.max_range, self.__scan_step, self.ray_casting, self.measurement_model) for chunk in chunks]
+            return np.concatenate(self.__pool.map(_squared_errors_worker, jobs))
+        return compute_squared_errors(env, particles, real_distances, phis, sensor.max_range, self.__scan_step, self.ray_casting, self.measurement_model, self.range_table)
+    
+    def _coarse_to_fine_errors(self, real_distances: np.ndarray, phis: np.ndarray, sensor: Sensor, env: Environment) -> np.ndarray:
+        # particles dropped on a coarse level are hopeless, they get zero weight and are replaced in resample
+        squared_errors = np.full(len(self.particles), np.inf)
+        candidates = np.arange(len(self.particles))
+        for level in range(len(self.pyramid.levels) - 1, 0, -1):
+            errors = self.pyramid.squared_errors(level, self.particles[candidates], real_distances, phis, sensor.max_range, self.__scan_step, self.ray_casting, self.measurement_model)
+            num_survivors = max(1, int(len(candidates) * self.__pyramid_survivors))
+            candidates = candidates[select_best(-errors, num_survivors)]
+        squared_errors[candidates] = self._squared_errors(self.particles[candidates], real_distances, phis, sensor, env)
+        return squared_errors
     
     def resample(self, env: Environment) -> None:
-        chosen_particles = random.choices(self.particles, self.weights, k=self.num_choosed)
-        mutated_chosen_particles = []
+        start = time.perf_counter()
+        if self.adaptive:
+            # KLD-sampling draws until it knows how many particles are needed and resizes the set
+            chosen, mutated_chosen_particles = self._kld_sample()
+        else:
+            chosen, mutated_chosen_particles = self._draw_chosen(self.num_choosed)
         
-        for x, y, theta in chosen_particles:
-            new_x = x + random.gauss(0, 2)
-            new_y = y + random.gauss(0, 2)
-            new_theta = theta + random.gauss(0, 0.2)
-            mutated_chosen_particles.append((new_x, new_y, new_theta))
+        # a set that grew has fewer old particles than num_kept, the resampled part makes up for it
+        num_kept = min(self.num_kept, len(self.particles))
+        num_choosed = self.num_particles - self.num_generated - num_kept
+        if len(chosen) < num_choosed:
+            more_chosen, more_particles = self._draw_chosen(num_choosed - len(chosen))
+            chosen = np.concatenate((chosen, more_chosen))
+            mutated_chosen_particles = np.concatenate((mutated_chosen_particles, more_particles))
+        chosen, mutated_chosen_particles = chosen[:num_choosed], mutated_chosen_particles[:num_choosed]
         
         generated_particles = self._generate_random_particles(self.num_generated, env)
         
-        paired = zip(self.particles, self.weights)
-        sorted_particles = sorted(paired, key=lambda x: x[1], reverse=True)
-        kept_particles = [p for p, w in sorted_particles[0:self.num_kept-1]]
+        kept = select_best(self.weights, num_kept)
+        kept_particles = self.particles[kept]
+        
+        self.particles = np.concatenate((mutated_chosen_particles, generated_particles, kept_particles))
+        self.rejected = None
+        # weights travel with their particles, fresh random particles have no support yet
+        weights = np.concatenate((self.weights[chosen], np.zeros(self.num_generated), self.weights[kept]))
+        self.weights = weights / weights.sum()
+        self.step_times["resample"] = time.perf_counter() - start
+    
+    def _draw_chosen(self, num_samples: int) -> tuple[np.ndarray, np.ndarray]:
+        # indices drawn according to the weights and the drawn particles moved by a bit of noise
+        chosen = RESAMPLING_METHODS[self.resampling](self.weights, num_samples, self.__rng)
+        return chosen, self.particles[chosen] + self.__rng.normal(0, (2, 2, 0.2), (num_samples, 3))
+    
+    def _kld_sample(self) -> tuple[np.ndarray, np.ndarray]:
+        # KLD-sampling (Fox): draw resampled and perturbed particles until their number n reaches the bound
+        # for the k histogram bins they occupy, spread out posterior -> many bins -> many particles
+        # samples are drawn in chunks starting at the current size, a converged filter draws only a few hundred
+        ratio_chosen = 1.0 - self.__ratio_kept - self.__ratio_generated
+        min_samples = math.ceil(self.min_particles * ratio_chosen)
+        max_samples = math.ceil(self.max_particles * ratio_chosen)
+        chunk_size = max(self.num_choosed, min_samples)
         
-        self.particles = mutated_chosen_particles + generated_particles + kept_particles
+        chosen_chunks, sample_chunks = [], []
+        occupied = np.empty(0, dtype=np.int64)
+        num_drawn = 0
+        num_needed = max_samples
+        while num_drawn < max_samples:
+            size = min(chunk_size, max_samples - num_drawn)
+            chosen, samples = self._draw_chosen(size)
+            # systematic / stratified return sorted indices, the bound may be met inside the chunk
+            order = np.argsort(self.__rng.random(size))
+            chosen, samples = chosen[order], samples[order]
+            chosen_chunks.append(chosen)
+            sample_chunks.append(samples)
+            
+            keys = self._kld_bin_keys(samples)
+            _, first = np.unique(keys, return_index=True)
+            is_new_bin = np.zeros(size, dtype=bool)
+            is_new_bin[first] = True
+            is_new_bin &= ~np.isin(keys, occupied)
+            k = len(occupied) + np.cumsum(is_new_bin)       # bins occupied by the first n samples
+            n = num_drawn + np.arange(1, size + 1)
+            occupied = np.union1d(occupied, keys)
+            num_drawn += size
+            
+            a = 2.0 / (9.0 * np.maximum(k - 1, 1))
+            bound = (k - 1) / (2.0 * self.__kld_epsilon) * (1.0 - a + np.sqrt(a) * self.__kld_z) ** 3
+            # the bound is 0 for a single bin, never stop before min_samples
+            enough = np.flatnonzero((n >= bound) & (n >= min_samples))
+            if len(enough) > 0:
+                num_needed = n[enough[0]]
+                break
+            chunk_size *= 2
         
+        # the bound is for the resampled part, kept and generated particles come on top of it
+        self._set_num_particles(self._limit_kld_change(math.ceil(num_needed / ratio_chosen)))
+        return np.concatenate(chosen_chunks), np.concatenate(sample_chunks)
+    
+    def _kld_bin_keys(self, samples: np.ndarray) -> np.ndarray:
+        # one int64 per (x, y, theta) bin, x and y shifted so that particles slightly off the map stay positive
+        x_bins = np.floor(samples[:, 0] / self.__kld_bin_size[0]).astype(np.int64) + (1 << 20)
+        y_bins = np.floor(samples[:, 1] / self.__kld_bin_size[1]).astype(np.int64) + (1 << 20)
+        theta_bins = np.floor(np.mod(samples[:, 2], 2 * math.pi) / self.__kld_bin_size[2]).astype(np.int64)
+        return (x_bins << 26) + (y_bins << 5) + theta_bins
+    
+    def _limit_kld_change(self, num_particles: int) -> int:
+        # growing is never limited, shrinking waits for usable weights and goes step by step
+        current = len(self.particles)
+        self.__kld_updates_left = max(self.__kld_updates_left - 1, 0)
+        if num_particles < current:
+            if self.__kld_updates_left > 0 or self.ess < self.__kld_min_ess_ratio * current:
+                num_particles = current
+            else:
+                num_particles = max(num_particles, math.ceil(current * (1.0 - self.__kld_max_shrink)))
+        return int(np.clip(num_particles, self.min_particles, self.max_particles))
+    
+    def estimate(self) -> None:
+        # average of the best weighted particles, angles averaged on the unit circle
+        particles, weights = self.particles, self.weights
+        best = select_best(weights, self.num_estimated)
+        x, y, theta = particles[best].T
+        
+        self.x_estimated = x.mean()
+        self.y_estimated = y.mean()
+        self.theta_estimated = math.atan2(np.sin(theta).mean(), np.cos(theta).mean())
+    
     def draw(self, screen: pygame.Surface, show_particles: bool = True, show_estimate: bool = False, radius: int = 10) -> None:
         if show_particles:
-            for x, y, _ in self.particles:
-                pygame.draw.circle(screen, COLOR_PARTICLES, (int(x), int(y)), self.__particle_size)
+            if self.__particle_layer is None or self.__frames_since_render >= self.render_every:
+                self._render_particles(screen.get_size())
+                self.__frames_since_render = 0
+            self.__frames_since_render += 1
+            screen.blit(self.__particle_layer, (0, 0))
             
         if not show_estimate:
             return
         
-        paired = zip(self.particles, self.weights)
-        sorted_particles = sorted(paired, key=lambda x: x[1], reverse=True)
-        kept_particles = [p for p, w in sorted_particles[:self.num_estimated]]
-        
-        sum_x = 0.0
-        sum_y = 0.0
-        sum_sin = 0.0
-        sum_cos = 0.0
-        for x, y, theta in kept_particles:
-            sum_x += x
-            sum_y += y
-            sum_sin += math.sin(theta)
-            sum_cos += math.cos(theta)
-        
-        avg_x = sum_x/self.num_estimated
-        avg_y = sum_y/self.num_estimated
-        avg_theta = math.atan2(sum_sin / self.num_estimated, sum_cos / self.num_estimated)
-        
+        avg_x, avg_y, avg_theta = self.x_estimated, self.y_estimated, self.theta_estimated
         pygame.draw.circle(screen, COLOR_ESTIMATE, (int(avg_x), int(avg_y)), radius, self.__estimate_line_thickness)
         nose_x = avg_x + math.cos(avg_theta) * (radius * 1.2)
         nose_y = avg_y + math.sin(avg_theta) * (radius * 1.2)
         pygame.draw.line(screen, COLOR_ESTIMATE, (int(avg_x), int(avg_y)), (int(nose_x), int(nose_y)), self.__estimate_line_thickness)
     
-    def _generate_random_particles(self, num_particles: int, env: Environment):
-        new_particles = []
-        while len(new_particles) != num_particles:
-                x = random.uniform(0, env.width)
-                y = random.uniform(0, env.height)
-                if not env.is_collision(x, y):
-                    theta = random.uniform(0, 2 * math.pi)
-                    new_particles.append((x, y, theta))
-        return new_particles
+    def _render_particles(self, size: tuple[int, int]) -> None:
+        layer = pygame.Surface(size, pygame.SRCALPHA)
+        particles = self.particles
+        x, y = particles[:, 0], particles[:, 1]
+        if self.render_mode == "points":
+            draw_points(layer, x, y, COLOR_PARTICLES, self.__particle_size)
+        else:
+            draw_heatmap(layer, x, y, self.__heatmap_cell_size)
+        self.__particle_layer = layer
+    
+    def _generate_random_particles(self, num_particles: int, env: Environment) -> np.ndarray:
+        x, y = env.sample_free(num_particles, self.__rng)
+        theta = self.__rng.uniform(0, 2 * math.pi, num_particles)
+        return np.column_stack((x, y, theta))
+    
+    def _start_workers(self, env: Environment) -> None:
+        # the map is copied once into shared memory, workers only attach to it
+        shared_arrays = []
+        for array in (env.collision_grid, env.distance_field, env.surface_distance_field):
+            shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+            self.__shared_memory.append(shm)
+            shared_arrays.append((shm.name, array.shape, array.dtype.str))
+        self.__pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker, initargs=(shared_arrays, env.max_obstacle_distance))
+    
+    def close(self) -> None:
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+        for shm in self.__shared_memory:
+            shm.close()
+            shm.unlink()
+        self.__shared_memory = []
     
     def reset_particles(self, env: Environment):
+        if self.adaptive:
+            self._set_num_particles(self.max_particles)
         self.particles = self._generate_random_particles(self.num_particles, env)
+        self.weights = np.full(self.num_particles, 1.0 / self.num_particles)
+        self.ess = float(self.num_particles)
+        self.rejected = None
+        self.__coarse_updates_left = self.__pyramid_updates
+        self.__kld_updates_left = self.__kld_warmup_updates
                 
+##################################################################
+class FilterWorker:
+    # runs predict/update_weights/resample in a background thread, the game loop only submits data and draws
+    def __init__(self, pf: ParticleFilter, env: Environment, sensor: Sensor, queue_size: int = 4):
+        self.pf = pf
+        self.env = env
+        self.sensor = sensor
+        self.queue_size = queue_size
+        
+        self.processed_scans = 0
+        self.dropped_scans = 0
+        self.filter_rate = 0.0
+        
+        # every item is ([(v, w, dt), ...], scan)
+        self.__queue = collections.deque()
+        self.__condition = threading.Condition()
+        self.__reset_requested = False
+        self.__running = False
+        self.__thread = threading.Thread(target=self._run, daemon=True)
+    
+    @property
+    def queue_depth(self) -> int:
+        return len(self.__queue)
+    
+    def start(self) -> None:
+        self.__running = True
+        self.__thread.start()
+    
+    def stop(self) -> None:
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        self.__thread.join()
+    
+    def submit(self, v: float, w: float, dt: float, scan) -> None:
+        with self.__condition:
+            odometry = [(v, w, dt)]
+            if len(self.__queue) >= self.queue_size:
+                # the oldest scan is dropped, but its motion still has to be applied
+                old_odometry, _ = self.__queue.popleft()
+                if self.__queue:
+                    next_odometry, next_scan = self.__queue[0]
+                    self.__queue[0] = (old_odometry + next_odometry, next_scan)
+                else:
+                    odometry = old_odometry + odometry
+                self.dropped_scans += 1
+            self.__queue.append((odometry, scan))
+            self.__condition.notify()
+    
+    def reset_particles(self) -> None:
+        with self.__condition:
+            self.__reset_requested = True
+            self.__condition.notify()
+    
+    def _run(self) -> None:
+        while True:
+            with self.__condition:
+                while self.__running and not self.__queue and not self.__reset_requested:
+                    self.__condition.wait()
+                if not self.__running:
+                    return
+                reset, self.__reset_requested = self.__reset_requested, False
+                item = self.__queue.popleft() if self.__queue else None
+            
+            if reset:
+                self.pf.reset_particles(self.env)
+            if item is None:
+                continue
+            
+            start = time.perf_counter()
+            odometry, scan = item
+            for v, w, dt in odometry:
+                self.pf.predict(v, w, dt, self.env)
+            self.pf.update_weights(scan, self.sensor, self.env)
+            self.pf.resample(self.env)
+            self.pf.estimate()
+            self.processed_scans += 1
+            self.filter_rate = 1.0 / max(time.perf_counter() - start, 1e-6)
+
+##################################################################
+# CONTROLS #######################################################
+##################################################################
+def keys_to_command(keys, max_v: float, max_w: float) -> tuple[float, float]:
+    # pressed keys -> commanded (v, w), shared by the game robot and the batch simulator
+    cmd_v = 0.0
+    cmd_w = 0.0
+    
+    # forward/backward
+    if keys[pygame.K_UP] or keys[pygame.K_w]:
+        cmd_v = max_v
+    if keys[pygame.K_DOWN] or keys[pygame.K_s]:
+        cmd_v = -max_v / 2.0
+    
+    # left/right
+    if keys[pygame.K_LEFT] or keys[pygame.K_a]:
+        cmd_w = -max_w
+    if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
+        cmd_w = max_w
+    return cmd_v, cmd_w
+
+##################################################################
+# MEASUREMENT MODEL ##############################################
+##################################################################
+def compute_squared_errors(env: Environment, particles: np.ndarray, real_distances: np.ndarray, phis: np.ndarray, max_range: float, scan_step: float,
+                           ray_casting: str = "march", measurement_model: str = "beam", range_table: RangeTable = None) -> np.ndarray:
+    # sum over beams of the squared measurement error, one value per particle
+    x, y, theta = particles.T
+    angles = theta[:, None] + phis
+    if measurement_model == "likelihood_field":
+        # no ray casting, each beam endpoint is scored by its distance to the nearest wall surface
+        # smoother and more precise than the beam model when tracking, but with the few beams we score
+        # many wrong poses fit almost as well - global localization needs a lot of particles (~5000)
+        end_x = x[:, None] + real_distances * np.cos(angles)
+        end_y = y[:, None] + real_distances * np.sin(angles)
+        errors = env.surface_distance_batch(end_x, end_y)
+    else:
+        if range_table is not None:
+            expected_distances = range_table.lookup(x[:, None], y[:, None], angles)
+        elif ray_casting == "python":
+            expected_distances = env.cast_rays_python(x, y, angles, max_range, scan_step)
+        elif ray_casting == "march":
+            expected_distances = env.cast_rays_march(x[:, None], y[:, None], angles, max_range, scan_step)
+        else:
+            expected_distances = env.cast_rays_dda(x[:, None], y[:, None], angles, max_range)
+        errors = real_distances - expected_distances
+    return (errors ** 2).sum(axis=1)
+
+# state of a worker process, set once by _init_worker
+_worker_env = None
+_worker_shared_memory = []
+
+def _init_worker(shared_arrays, max_obstacle_distance: float) -> None:
+    global _worker_env
+    arrays = []
+    for name, shape, dtype in shared_arrays:
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_shared_memory.append(shm)   # keep the buffer alive
+        arrays.append(np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+    collision_grid, distance_field, surface_distance_field = arrays
+    _worker_env = Environment.from_grids(collision_grid, distance_field, max_obstacle_distance, surface_distance_field)
+
+def _squared_errors_worker(job) -> np.ndarray:
+    return compute_squared_errors(_worker_env, *job)
+
+##################################################################
+# RESAMPLING #####################################################
+##################################################################
+# every method returns indices of num_samples particles drawn according to the (normalized) weights
+
+def multinomial_resample(weights: np.ndarray, num_samples: int, rng: RandomStream) -> np.ndarray:
+    # roulette wheel, independent draws
+    return rng.choice(len(weights), size=num_samples, p=weights)
+
+def systematic_resample(weights: np.ndarray, num_samples: int, rng: RandomStream) -> np.ndarray:
+    # one random offset, equally spaced pointers; count the pointers below every cumulative weight in O(N)
+    cumulative = np.cumsum(weights)
+    cumulative[-1] = 1.0
+    pointers_below = np.floor(cumulative * num_samples - rng.random()).astype(int) + 1
+    counts = np.diff(np.clip(pointers_below, 0, num_samples), prepend=0)
+    return np.repeat(np.arange(len(weights)), counts)
+
+def stratified_resample(weights: np.ndarray, num_samples: int, rng: RandomStream) -> np.ndarray:
+    # one random pointer inside each of the num_samples equal strata
+    cumulative = np.cumsum(weights)
+    cumulative[-1] = 1.0
+    pointers = (np.arange(num_samples) + rng.random(num_samples)) / num_samples
+    return np.searchsorted(cumulative, pointers)
+
+def residual_resample(weights: np.ndarray, num_samples: int, rng: RandomStream) -> np.ndarray:
+    # deterministic copies of the integer part, the rest systematically from the residual weights
+    expected = weights * num_samples
+    counts = np.floor(expected).astype(int)
+    indices = np.repeat(np.arange(len(weights)), counts)
+    num_residual = num_samples - counts.sum()
+    if num_residual > 0:
+        residual = expected - counts
+        indices = np.concatenate((indices, systematic_resample(residual / residual.sum(), num_residual, rng)))
+    return indices
+
+RESAMPLING_METHODS = {
+    "multinomial": multinomial_resample,
+    "systematic": systematic_resample,
+    "stratified": stratified_resample,
+    "residual": residual_resample,
+}
+
+def select_best(weights: np.ndarray, k: int) -> np.ndarray:
+    # indices of the k largest weights in no particular order, O(N) partial selection instead of a full sort
+    n = len(weights)
+    if k <= 0:
+        return np.zeros(0, dtype=int)
+    if k >= n:
+        return np.arange(n)
+    return np.argpartition(weights, n - k)[n - k:]
+
+##################################################################
+# DRAWING ########################################################
+##################################################################
+def draw_points(surface: pygame.Surface, xs: np.ndarray, ys: np.ndarray, color: tuple[int, int, int], radius: int = 1) -> None:
+    # stamps a small disc at every point straight into the pixel array, no draw call per point
+    ix = np.asarray(xs).astype(int)
+    iy = np.asarray(ys).astype(int)
+    dx, dy = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disc = dx ** 2 + dy ** 2 <= radius ** 2
+    px = (ix[:, None] + dx[disc]).ravel()
+    py = (iy[:, None] + dy[disc]).ravel()
+    
+    width, height = surface.get_size()
+    inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+    px, py = px[inside], py[inside]
+    
+    pixels = pygame.surfarray.pixels3d(surface)
+    pixels[px, py] = color
+    del pixels     # unlocks the surface
+    if surface.get_flags() & pygame.SRCALPHA:
+        alpha = pygame.surfarray.pixels_alpha(surface)
+        alpha[px, py] = 255
+        del alpha
+
+def draw_heatmap(surface: pygame.Surface, xs: np.ndarray, ys: np.ndarray, cell_size: int) -> None:
+    # 2D histogram of the points, colored from low to high density and blitted as one surface
+    width, height = surface.get_size()
+    cells_x = math.ceil(width / cell_size)
+    cells_y = math.ceil(height / cell_size)
+    ix = np.asarray(xs).astype(int) // cell_size
+    iy = np.asarray(ys).astype(int) // cell_size
+    inside = (ix >= 0) & (ix < cells_x) & (iy >= 0) & (iy < cells_y)
+    counts = np.bincount(ix[inside] * cells_y + iy[inside], minlength=cells_x * cells_y).reshape(cells_x, cells_y)
+    if counts.max() == 0:
+        return
+    
+    density = np.sqrt(counts / counts.max())[:, :, None]
+    colors = (1.0 - density) * np.array(COLOR_HEATMAP_LOW) + density * np.array(COLOR_HEATMAP_HIGH)
+    heatmap = pygame.Surface((cells_x, cells_y), pygame.SRCALPHA)
+    pygame.surfarray.blit_array(heatmap, colors.astype(np.uint8))
+    alpha = pygame.surfarray.pixels_alpha(heatmap)
+    alpha[:] = np.where(counts > 0, 80 + 175 * density[:, :, 0], 0).astype(np.uint8)
+    del alpha
+    surface.blit(pygame.transform.scale(heatmap, (cells_x * cell_size, cells_y * cell_size)), (0, 0))
+
 ##################################################################
 # MAIN ###########################################################
 ##################################################################
@@ -312,7 +1175,9 @@ def main():
     print("[h] show/hide estimated position")
     print("[j] show/hide sensor data")
     print("[k] show/hide particles")
-    print("[l] show/hide map\n")
+    print("[l] show/hide map")
+    print("[u] particles as points/heat map")
+    print("[p] show/hide profiler overlay (PROFILE = True)\n")
     
     screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
     pygame.display.set_caption("Particle Filter Simulator")
@@ -320,17 +1185,46 @@ def main():
     
     path = os.path.join(".", "img", "map2.bmp")
     env = Environment(path)
-    lidar = Sensor(360.0, 60, 0.5, 200)
-    robot = Robot(x=100, y=200, theta=3, sensor=lidar)
+    rng_sensor, rng_filter = RandomStream(SEED).spawn(2)
+    lidar = Sensor(360.0, 60, 0.5, 200, rng=rng_sensor)
+    robot = Robot(x=100, y=200, theta=3, sensor=lidar, motion_check="endpoint" if MOTION_CHECK == "endpoint" else "stop")
     
     # -------- PARTICLE FILTER INIT --------
-    pf = ParticleFilter(800, env, None)
+    pf = ParticleFilter(800, env, None, motion_check=MOTION_CHECK, rng=rng_filter)
+    
+    # # >>> precomputed expected ranges, built once per map and cached next to it
+    # range_table = RangeTable(env, lidar.max_range)
+    # pf = ParticleFilter(800, env, None, range_table=range_table, rng=rng_filter)
+    
+    # # >>> global localization on big maps: first scores on 1/8, 1/4, 1/2 resolution, only the best half goes on
+    # pf = ParticleFilter(800, env, None, pyramid_levels=4, rng=rng_filter)
     # --------------------------------------
     
+    recorder = None
+    if SESSION_LOG is not None:
+        recorder = SessionRecorder(SESSION_LOG, {
+            "map": path,
+            "fps": FPS,
+            "sensor": {"fov_degrees": 360.0, "num_rays": lidar.num_rays, "noise_std": lidar.noise_std, "max_range": lidar.max_range},
+        })
+    
+    # -------- PROFILER --------
+    profiler = StageProfiler(PROFILE, trace=PROFILE_OUTPUT is not None)
+    for obj, method in [(robot, "update"), (robot, "do_scan"), (pf, "predict"), (pf, "update_weights"), (pf, "resample"), (pf, "estimate"), (pf, "draw")]:
+        profiler.instrument(obj, method)
+    flip = profiler.wrap("display.flip", pygame.display.flip)
+    # --------------------------
+    
+    worker = None
+    if FILTER_IN_BACKGROUND:
+        worker = FilterWorker(pf, env, lidar)
+        worker.start()
+    
     map_visible = False
     particles_visible = False
     sensor_visible = True
     estimate_visible = False
+    profiler_visible = PROFILE
     
     running = True
     while running:
@@ -348,25 +1242,53 @@ def main():
         elif keys[pygame.K_j]:
             sensor_visible = not sensor_visible
         elif keys[pygame.K_i]:
-            pf.reset_particles(env)
+            if worker is not None:
+                worker.reset_particles()
+            else:
+                pf.reset_particles(env)
         elif keys[pygame.K_h]:
             estimate_visible = not estimate_visible
+        elif keys[pygame.K_u]:
+            pf.render_mode = "heatmap" if pf.render_mode == "points" else "points"
+        elif keys[pygame.K_p]:
+            profiler_visible = not profiler_visible
         
         env.draw(screen, map_visible)
         
         v, w = robot.update(keys, dt, env)
         robot.do_scan(env)
         robot.draw(screen, sensor_visible)
+        if recorder is not None:
+            recorder.write(keys, v, w, dt, (robot.x, robot.y, robot.theta), robot.last_scan)
         
         # ------ PARTICLE FILTER ALGORHITM -----
-        pf.predict(v, w, dt, env)
-        pf.update_weights(robot.last_scan, lidar, env)
-        pf.resample(env)
+        if worker is not None:
+            worker.submit(v, w, dt, robot.last_scan)
+        else:
+            pf.predict(v, w, dt, env)
+            pf.update_weights(robot.last_scan, lidar, env)
+            pf.resample(env)
+            pf.estimate()
         pf.draw(screen, particles_visible, estimate_visible)
         # --------------------------------------
         
-        pygame.display.flip()
+        if profiler_visible:
+            profiler.draw(screen)
+        flip()
+        caption = f"Particle Filter Simulator - {pf.num_particles} particles (ESS {pf.ess:.0f}), {pf.frame_time * 1000:.1f} ms"
+        if worker is not None:
+            caption += f", queue {worker.queue_depth}/{worker.queue_size}, dropped {worker.dropped_scans}, filter {worker.filter_rate:.0f} Hz"
+        pygame.display.set_caption(caption)
     
+    if worker is not None:
+        worker.stop()
+    if recorder is not None:
+        recorder.close()
+        print(f"Session with {recorder.num_frames} frames saved to {recorder.filepath}")
+    if PROFILE and PROFILE_OUTPUT is not None:
+        profiler.dump(PROFILE_OUTPUT)
+        print(f"Profile with {len(profiler.events)} calls saved to {PROFILE_OUTPUT}")
+    pf.close()
     pygame.quit()
 
 ##################################################################
@@ -0,0 +1,100 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")   # no window, must be set before pygame starts
+
+import pygame
+import numpy as np
+import argparse
+import json
+import time
+
+from random_streams import RandomStream
+from session_log import SessionReader
+from particle_filter_game import Environment, Sensor, ParticleFilter, WINDOW_WIDTH, WINDOW_HEIGHT
+from particle_filter_benchmark import StageTimer, NUM_PARTICLES
+
+##################################################################
+# CONSTANTS ######################################################
+##################################################################
+FILTER_STAGES = ["predict", "update_weights", "resample", "estimate"]
+
+##################################################################
+# REPLAY #########################################################
+##################################################################
+def replay(log_filepath: str, num_particles: int = NUM_PARTICLES, seed: int = None, **pf_kwargs) -> dict:
+    # feeds recorded odometry and scans to the filter as fast as it can go, no robot and no window
+    log = SessionReader(log_filepath)
+    pygame.init()
+    pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+
+    env = Environment(log.metadata["map"])
+    lidar = Sensor(**log.metadata["sensor"])
+    pf = ParticleFilter(num_particles, env, None, rng=RandomStream(seed), **pf_kwargs)
+
+    timer = StageTimer(FILTER_STAGES)
+    errors = []
+    recorded_time = 0.0
+    start = time.perf_counter()
+    for frame in log:
+        if frame.keys[pygame.K_i]:
+            pf.reset_particles(env)
+        timer.measure("predict", pf.predict, frame.v, frame.w, frame.dt, env)
+        timer.measure("update_weights", pf.update_weights, frame.scan, lidar, env)
+        timer.measure("resample", pf.resample, env)
+        timer.measure("estimate", pf.estimate)
+        x, y, _ = frame.pose
+        errors.append(np.hypot(pf.x_estimated - x, pf.y_estimated - y))
+        recorded_time += frame.dt
+    wall_time = time.perf_counter() - start
+    pf.close()
+    pygame.quit()
+
+    return {
+        "config": {"log": log_filepath, "num_particles": num_particles, "seed": seed, **pf_kwargs},
+        "stages": timer.summary(),
+        "num_frames": len(errors),
+        "recorded_time_s": recorded_time,
+        "wall_time_s": wall_time,
+        "speedup_over_realtime": recorded_time / wall_time if errors else 0.0,
+        "final_position_error": float(errors[-1]) if errors else None,
+        "mean_position_error": float(np.mean(errors)) if errors else None,
+    }
+
+##################################################################
+# MAIN ###########################################################
+##################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded game session through the particle filter")
+    parser.add_argument("log", help="session log written by the game (SESSION_LOG) or the benchmark (--record)")
+    parser.add_argument("--particles", type=int, default=NUM_PARTICLES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ray-casting", default="march", choices=["python", "march", "dda"])
+    parser.add_argument("--measurement-model", default="beam", choices=["beam", "likelihood_field"])
+    parser.add_argument("--resampling", default="systematic", choices=["multinomial", "systematic", "stratified", "residual"])
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = replay(
+        args.log, args.particles, args.seed,
+        ray_casting=args.ray_casting,
+        measurement_model=args.measurement_model,
+        resampling=args.resampling,
+    )
+
+    print(f"\n ---- REPLAY OF {args.log} ({report['num_frames']} frames, {args.particles} particles) ---- \n")
+    print(f"{'stage':<16}{'mean [ms]':>12}{'p95 [ms]':>12}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<16}{stats['mean_ms']:>12.3f}{stats['p95_ms']:>12.3f}")
+    if report["num_frames"] == 0:
+        print("\nlog has no frames, nothing was replayed\n")
+    else:
+        print(f"\nrecorded {report['recorded_time_s']:.1f} s replayed in {report['wall_time_s']:.1f} s ({report['speedup_over_realtime']:.1f}x real time)")
+        print(f"mean position error: {report['mean_position_error']:.1f} px\n")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Report saved to {args.output}")
+
+##################################################################
+if __name__ == "__main__":
+    main()
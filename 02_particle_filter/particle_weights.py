@@ -0,0 +1,88 @@
+import numpy as np
+import time
+
+##################################################################
+# PARTICLE WEIGHTS ###############################################
+##################################################################
+# weights are kept as log-likelihoods until the very end: a product of hundreds of small likelihoods
+# underflows to 0.0 in floating point, a sum of their logs does not
+# every function works along the last axis, so (N,) weights of one filter or (K, N) of K filters
+
+def gaussian_log_likelihood(squared_errors, std):
+    # log N(e; 0, std^2) without the constant term, which cancels in normalization
+    # summed squared errors of several measurements = log of the product of their likelihoods
+    return -0.5 * np.asarray(squared_errors, dtype=float) / std ** 2
+
+def log_sum_exp(log_values):
+    # log(sum(exp(x))) with the largest term factored out, exp never overflows and the largest term is exp(0) = 1
+    log_values = np.asarray(log_values, dtype=float)
+    top = np.max(log_values, axis=-1, keepdims=True)
+    # all -inf (no particle explains the data): keep -inf instead of nan
+    safe_top = np.where(np.isfinite(top), top, 0.0)
+    with np.errstate(divide="ignore"):
+        return (safe_top + np.log(np.sum(np.exp(log_values - safe_top), axis=-1, keepdims=True))).squeeze(-1)
+
+def normalize_log_weights(log_weights):
+    # normalized weights summing to 1, uniform if every particle has zero likelihood
+    log_weights = np.asarray(log_weights, dtype=float)
+    log_total = log_sum_exp(log_weights)[..., None]
+    with np.errstate(invalid="ignore"):
+        weights = np.exp(log_weights - log_total)
+    degenerate = ~np.isfinite(log_total)
+    return np.where(degenerate, 1.0 / log_weights.shape[-1], weights)
+
+def effective_sample_size(weights):
+    # 1 / sum(w^2) of normalized weights: N for uniform weights, 1 when one particle has all the weight
+    weights = np.asarray(weights, dtype=float)
+    return 1.0 / np.sum(weights ** 2, axis=-1)
+
+def reweight(weights, log_likelihoods):
+    # posterior = prior weights x new likelihoods, for filters that keep their weights between steps
+    with np.errstate(divide="ignore"):
+        return normalize_log_weights(np.log(np.asarray(weights, dtype=float)) + log_likelihoods)
+
+##################################################################
+# SELECTIVE RESAMPLING ###########################################
+##################################################################
+class SelectiveResampler:
+    # resample only when the weights degenerate: effective sample size below threshold * N
+    # between resamplings the filter must carry its weights (reweight) instead of starting from uniform
+    # threshold 1.0 resamples on (almost) every step like the classic filter, 0.5 is the usual choice
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.num_steps = 0
+        self.num_resampled = 0
+        self.resample_time = 0.0
+        self.ess_history = []
+
+    def needs_resampling(self, weights):
+        weights = np.asarray(weights, dtype=float)
+        ess = float(effective_sample_size(weights))
+        self.ess_history.append(ess)
+        self.num_steps += 1
+        return ess < self.threshold * len(weights)
+
+    def run(self, resample, *args, **kwargs):
+        # calls resample(*args, **kwargs) and measures it, the time saved is estimated from these calls
+        start = time.perf_counter()
+        result = resample(*args, **kwargs)
+        self.resample_time += time.perf_counter() - start
+        self.num_resampled += 1
+        return result
+
+    def summary(self):
+        num_skipped = self.num_steps - self.num_resampled
+        mean_time = self.resample_time / self.num_resampled if self.num_resampled else 0.0
+        return {
+            "steps": self.num_steps,
+            "resampled": self.num_resampled,
+            "skipped": num_skipped,
+            "mean_resample_ms": mean_time * 1000.0,
+            "time_saved_ms": num_skipped * mean_time * 1000.0,
+            "mean_ess": float(np.mean(self.ess_history)) if self.ess_history else 0.0,
+        }
+
+    def report(self):
+        s = self.summary()
+        return (f"resampled {s['resampled']} of {s['steps']} steps (ESS threshold {self.threshold:.0%} of N), skipped {s['skipped']}, "
+                f"saved ~{s['time_saved_ms']:.1f} ms ({s['mean_resample_ms']:.2f} ms per resampling)")
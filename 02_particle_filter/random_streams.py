@@ -0,0 +1,55 @@
+import numpy as np
+
+##################################################################
+# RANDOM STREAMS #################################################
+##################################################################
+# one seeded source of noise that can be passed around instead of the global 'random' module
+# same seed + same sequence of calls -> bit-identical results
+
+class RandomStream:
+    def __init__(self, seed=None, block_size: int = 4096):
+        # seed can be an int, None (random) or a np.random.SeedSequence
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.generator = np.random.Generator(np.random.PCG64(self.seed_sequence))
+
+        # scalar draws are served from a pre-generated block of standard normal noise
+        self.__block_size = block_size
+        self.__block = np.empty(0)
+        self.__index = 0
+
+    def __deepcopy__(self, memo):
+        # a stream is a shared source, not part of the state - copied particles must keep drawing
+        # from the same stream, otherwise copies of one particle would all get identical noise
+        return self
+
+    def spawn(self, num_streams: int) -> list["RandomStream"]:
+        # independent child streams, e.g. robot, sensor and particles each get one
+        # so changing the number of particles does not change what the robot does
+        return [RandomStream(child, self.__block_size) for child in self.seed_sequence.spawn(num_streams)]
+
+    # --- batched noise (numpy.random.Generator interface)
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        return self.generator.normal(loc, scale, size)
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return self.generator.uniform(low, high, size)
+
+    def random(self, size=None):
+        return self.generator.random(size)
+
+    def choice(self, a, size=None, p=None):
+        return self.generator.choice(a, size=size, p=p)
+
+    # --- drop-in replacements for the 'random' module
+    def gauss(self, mu: float, sigma: float) -> float:
+        if self.__index >= len(self.__block):
+            self.__block = self.generator.standard_normal(self.__block_size)
+            self.__index = 0
+        value = self.__block[self.__index]
+        self.__index += 1
+        return float(mu + sigma * value)
+
+    def choices(self, population, weights, k: int) -> list:
+        weights = np.asarray(weights, dtype=float)
+        indices = self.generator.choice(len(population), size=k, p=weights / weights.sum())
+        return [population[i] for i in indices]
@@ -0,0 +1,90 @@
+import pygame
+import numpy as np
+import json
+import struct
+import time
+from collections import namedtuple
+
+##################################################################
+# SESSION LOG ####################################################
+##################################################################
+# append-only binary log of a game session, one record per frame
+# the recorder flushes at least every flush_interval seconds, a crashed game loses only the last frames
+#   header  "PFLOG1" | metadata length (uint32) | metadata (JSON)
+#   frame   index (uint32) | pressed keys (uint16 bitmask) | v, w, dt (float32)
+#           true pose x, y, theta (float32) | number of beams (uint16) | beams (n x 2 float32: distance, angle)
+
+MAGIC = b"PFLOG1"
+FRAME_FORMAT = struct.Struct("<IHffffffH")
+
+# keys used by the game, their order gives the bit in the mask
+RECORDED_KEYS = [
+    pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT,
+    pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d,
+    pygame.K_i, pygame.K_h, pygame.K_j, pygame.K_k, pygame.K_l, pygame.K_u, pygame.K_p,
+]
+
+SessionFrame = namedtuple("SessionFrame", ["index", "keys", "v", "w", "dt", "pose", "scan"])
+
+class SessionRecorder:
+    def __init__(self, filepath: str, metadata: dict, buffer_size: int = 1 << 20, flush_interval: float = 1.0):
+        self.filepath = filepath
+        self.num_frames = 0
+        self.flush_interval = flush_interval
+        self.__file = open(filepath, "wb", buffering=buffer_size)
+        encoded = json.dumps(metadata).encode()
+        self.__file.write(MAGIC + struct.pack("<I", len(encoded)) + encoded)
+        self.flush()
+
+    def write(self, keys, v: float, w: float, dt: float, pose: tuple[float, float, float], scan) -> None:
+        mask = 0
+        for bit, key in enumerate(RECORDED_KEYS):
+            if keys[key]:
+                mask |= 1 << bit
+        beams = np.asarray(scan, dtype=np.float32).reshape(-1, 2)
+        self.__file.write(FRAME_FORMAT.pack(self.num_frames, mask, v, w, dt, *pose, len(beams)))
+        self.__file.write(beams.tobytes())
+        self.num_frames += 1
+        # the big buffer keeps writes cheap, flushing once a second bounds what a crash can lose
+        if time.perf_counter() - self.__last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self.__file.flush()
+        self.__last_flush = time.perf_counter()
+
+    def close(self) -> None:
+        self.__file.close()
+
+class SessionKeys:
+    # pressed keys decoded from the mask, indexable like pygame.key.get_pressed()
+    def __init__(self, mask: int):
+        self.mask = mask
+
+    def __getitem__(self, key: int) -> bool:
+        return key in RECORDED_KEYS and bool(self.mask >> RECORDED_KEYS.index(key) & 1)
+
+class SessionReader:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        with open(filepath, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filepath} is not a session log")
+            (length,) = struct.unpack("<I", f.read(4))
+            self.metadata = json.loads(f.read(length))
+            self.__data_offset = f.tell()
+
+    def __iter__(self):
+        with open(self.filepath, "rb") as f:
+            f.seek(self.__data_offset)
+            while True:
+                header = f.read(FRAME_FORMAT.size)
+                if len(header) < FRAME_FORMAT.size:
+                    return      # end of log (or a frame cut off by a crash)
+                index, mask, v, w, dt, x, y, theta, num_beams = FRAME_FORMAT.unpack(header)
+                data = f.read(num_beams * 8)
+                if len(data) < num_beams * 8:
+                    return
+                beams = np.frombuffer(data, dtype=np.float32).reshape(-1, 2)
+                scan = [tuple(beam) for beam in beams.astype(float).tolist()]
+                yield SessionFrame(index, SessionKeys(mask), v, w, dt, (x, y, theta), scan)
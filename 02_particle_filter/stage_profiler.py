@@ -0,0 +1,98 @@
+import pygame
+import numpy as np
+import json
+import time
+import threading
+import collections
+
+##################################################################
+# STAGE PROFILER #################################################
+##################################################################
+# wraps functions so every call is timed under a stage name
+# - rolling p50/p95/max over the last 'window' calls of each stage (on-screen overlay)
+# - optional full trace of all calls, dumped as CSV or Chrome trace JSON (chrome://tracing, ui.perfetto.dev)
+# a disabled profiler returns the functions unwrapped, so the game runs exactly the same code as without it
+
+COLOR_OVERLAY_TEXT = (255, 255, 255)
+COLOR_OVERLAY_BACKGROUND = (0, 0, 0, 160)
+
+class StageProfiler:
+    def __init__(self, enabled: bool = True, window: int = 300, trace: bool = False):
+        self.enabled = enabled
+        self.window = window
+        self.trace = trace
+        self.stages = {}                # stage -> deque of the last durations [s]
+        self.events = []                # (stage, start [s], duration [s], thread name), only when tracing
+        self.__origin = time.perf_counter()
+        self.__font = None
+
+    def wrap(self, stage: str, function):
+        if not self.enabled:
+            return function
+        samples = self.stages.setdefault(stage, collections.deque(maxlen=self.window))
+        events = self.events if self.trace else None
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            duration = time.perf_counter() - start
+            samples.append(duration)    # deque.append is atomic, the filter thread can record too
+            if events is not None:
+                events.append((stage, start - self.__origin, duration, threading.current_thread().name))
+            return result
+        return timed
+
+    def instrument(self, obj, method: str, stage: str = None) -> None:
+        # replaces obj.method by its timed version (on the instance only, the class is untouched)
+        if self.enabled:
+            setattr(obj, method, self.wrap(stage or f"{type(obj).__name__}.{method}", getattr(obj, method)))
+
+    def summary(self) -> dict:
+        report = {}
+        for stage, samples in list(self.stages.items()):
+            if not samples:
+                continue
+            samples_ms = np.array(samples) * 1000.0
+            p50, p95 = np.percentile(samples_ms, [50, 95])
+            report[stage] = {"p50_ms": float(p50), "p95_ms": float(p95), "max_ms": float(samples_ms.max()), "count": len(samples_ms)}
+        return report
+
+    def draw(self, screen: pygame.Surface, position: tuple[int, int] = (10, 10)) -> None:
+        if not self.enabled:
+            return
+        if self.__font is None:
+            self.__font = pygame.font.Font(None, 20)
+
+        rows = [["stage", "p50", "p95", "max [ms]"]]
+        for stage, stats in self.summary().items():
+            rows.append([stage, f"{stats['p50_ms']:.2f}", f"{stats['p95_ms']:.2f}", f"{stats['max_ms']:.2f}"])
+
+        # default font is not monospaced, columns are placed by hand
+        columns = [0, 200, 255, 310]
+        line_height = self.__font.get_linesize()
+        overlay = pygame.Surface((columns[-1] + 70, line_height * len(rows) + 8), pygame.SRCALPHA)
+        overlay.fill(COLOR_OVERLAY_BACKGROUND)
+        for row, cells in enumerate(rows):
+            for column, cell in zip(columns, cells):
+                overlay.blit(self.__font.render(cell, True, COLOR_OVERLAY_TEXT), (4 + column, 4 + row * line_height))
+        screen.blit(overlay, position)
+
+    def dump(self, filepath: str) -> None:
+        # format is picked by the extension: .csv or .json (Chrome trace)
+        if filepath.endswith(".csv"):
+            with open(filepath, "w") as f:
+                f.write("stage,start_s,duration_ms,thread\n")
+                for stage, start, duration, thread in self.events:
+                    f.write(f"{stage},{start:.6f},{duration * 1000.0:.4f},{thread}\n")
+        elif filepath.endswith(".json"):
+            threads = {}
+            trace_events = []
+            for stage, start, duration, thread in self.events:
+                tid = threads.setdefault(thread, len(threads))
+                trace_events.append({"name": stage, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": 0, "tid": tid})
+            for thread, tid in threads.items():
+                trace_events.append({"name": "thread_name", "ph": "M", "pid": 0, "tid": tid, "args": {"name": thread}})
+            with open(filepath, "w") as f:
+                json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+        else:
+            raise ValueError(f"Unknown profile format '{filepath}', use .csv or .json")
@@ -0,0 +1,221 @@
+import os
+import sys
+os.environ.setdefault("MPLBACKEND", "Agg")     # no windows, must be set before matplotlib starts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "02_particle_filter"))     # particle_filter_demo and the shared helpers
+
+import numpy as np
+import argparse
+import itertools
+import json
+import time
+import tracemalloc
+
+from random_streams import RandomStream
+from particle_weights import SelectiveResampler
+import particle_filter_demo as demo
+import pf_minimal as minimal
+import pf_oop as oop
+
+##################################################################
+# CONSTANTS ######################################################
+##################################################################
+FILTERS = ["demo", "minimal", "oop"]
+PARTICLE_COUNTS = [100, 500, 2000]
+LANDMARK_COUNTS = [2, 7, 20]
+STEP_COUNTS = [10, 30]
+NUM_REPEATS = 3
+
+##################################################################
+# FILTERS ########################################################
+##################################################################
+# one class per script, the same motion, measurement and resample functions the animated scripts use
+# step() moves the robot, measures, runs one filter step and returns the true and estimated (x, y)
+# landmarks are random within the script's map, so any number of them can be tested
+
+class DemoRunner:
+    # 02_particle_filter/particle_filter_demo.py - distances only, particles as list of tuples
+    bounds = (demo.MAP_MIN_X, demo.MAP_MAX_X, demo.MAP_MIN_Y, demo.MAP_MAX_Y)
+
+    def __init__(self, num_particles, landmarks, rng_robot, rng_sensor, rng_particles):
+        self.landmarks = landmarks
+        self.rng_robot, self.rng_sensor, self.rng_particles = rng_robot, rng_sensor, rng_particles
+        self.state = (0.0, 0.0, 0.0)
+        self.particles = [(0.0, 0.0, 0.0) for _ in range(num_particles)]
+        self.weights = [1.0 / num_particles] * num_particles
+        self.resampler = SelectiveResampler(demo.RESAMPLE_THRESHOLD)
+
+    def step(self):
+        self.state = demo.move_robot(self.state, self.rng_robot)
+        self.particles = [demo.move_particle(p, self.rng_particles) for p in self.particles]
+        distances = [demo.measure_distance(self.state, target, self.rng_sensor) for target in self.landmarks]
+        self.weights = demo.update_weights(self.particles, distances, self.landmarks, self.weights)
+        if self.resampler.needs_resampling(self.weights):
+            self.particles = self.resampler.run(demo.resample, self.particles, self.weights, self.rng_particles)
+            self.weights = [1.0 / len(self.particles)] * len(self.particles)
+        return self.state[:2], demo.get_estimate(self.particles, self.weights)[:2]
+
+class MinimalRunner:
+    # 03_slam/pf_minimal.py - distances only, particles as list of tuples
+    bounds = (minimal.MAP_X_MIN, minimal.MAP_X_MAX, minimal.MAP_Y_MIN, minimal.MAP_Y_MAX)
+
+    def __init__(self, num_particles, landmarks, rng_robot, rng_sensor, rng_particles):
+        self.landmarks = landmarks
+        self.rng_robot, self.rng_sensor, self.rng_particles = rng_robot, rng_sensor, rng_particles
+        self.state = (0.0, 0.0, 0.0)
+        self.particles = [(0.0, 0.0, 0.0) for _ in range(num_particles)]
+        self.weights = [1.0 / num_particles] * num_particles
+        self.resampler = SelectiveResampler(minimal.RESAMPLE_THRESHOLD)
+
+    def step(self):
+        self.state = minimal.move_robot(self.state, self.rng_robot)
+        self.particles = [minimal.update_particle(p, self.rng_particles) for p in self.particles]
+        measurements = [minimal.measure_distance(self.state, lm, self.rng_sensor) for lm in self.landmarks]
+        self.weights = minimal.update_weights(self.particles, self.landmarks, measurements, self.weights)
+        if self.resampler.needs_resampling(self.weights):
+            self.particles = self.resampler.run(minimal.resample, self.particles, self.weights, self.rng_particles)
+            self.weights = [1.0 / len(self.particles)] * len(self.particles)
+        return self.state[:2], minimal.get_estimate(self.particles, self.weights)[:2]
+
+class OopRunner:
+    # 03_slam/pf_oop.py - distances and angles, particles in a ParticleSet
+    bounds = (oop.MAP_X_MIN, oop.MAP_X_MAX, oop.MAP_Y_MIN, oop.MAP_Y_MAX)
+
+    def __init__(self, num_particles, landmarks, rng_robot, rng_sensor, rng_particles):
+        self.landmarks = landmarks
+        self.robot = oop.Robot(rng=rng_robot)
+        self.sensor = oop.Sensor(rng=rng_sensor)
+        self.pf = oop.ParticleFilter(num_particles, rng=rng_particles)
+        self.resampler = self.pf.resampler
+
+    def step(self):
+        self.robot.move(0.0, oop.DEF_STEP)
+        self.sensor.read(self.robot.get_pose(), self.landmarks)
+        self.pf.update(0.0, oop.DEF_STEP, self.sensor.last_measurement, self.landmarks)
+        self.pf.resample()
+        self.pf.estimate()
+        return (self.robot.x, self.robot.y), (self.pf.x_avg, self.pf.y_avg)
+
+RUNNERS = {"demo": DemoRunner, "minimal": MinimalRunner, "oop": OopRunner}
+
+def random_landmarks(bounds, num_landmarks, rng):
+    x_min, x_max, y_min, y_max = bounds
+    xs = rng.uniform(x_min, x_max, num_landmarks)
+    ys = rng.uniform(y_min, y_max, num_landmarks)
+    return list(zip(xs.tolist(), ys.tolist()))
+
+##################################################################
+# BENCHMARK ######################################################
+##################################################################
+def run_once(name: str, num_particles: int, num_landmarks: int, num_steps: int, seed: int, trace_memory: bool = False) -> dict:
+    # same seed -> same landmarks, robot path and noise, so the timed and the memory run are identical
+    rng_robot, rng_sensor, rng_particles, rng_landmarks = RandomStream(seed).spawn(4)
+    runner_class = RUNNERS[name]
+    landmarks = random_landmarks(runner_class.bounds, num_landmarks, rng_landmarks)
+
+    # tracemalloc slows down every allocation, time and memory are measured in separate runs
+    if trace_memory:
+        tracemalloc.start()
+    runner = runner_class(num_particles, landmarks, rng_robot, rng_sensor, rng_particles)
+    step_times = []
+    squared_errors = []
+    for _ in range(num_steps):
+        start = time.perf_counter()
+        (x, y), (x_est, y_est) = runner.step()
+        step_times.append(time.perf_counter() - start)
+        squared_errors.append((x_est - x) ** 2 + (y_est - y) ** 2)
+    peak_memory = 0
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "step_times": step_times,
+        "squared_errors": squared_errors,
+        "peak_memory": peak_memory,
+        "resampling": runner.resampler.summary(),
+    }
+
+def run_config(name: str, num_particles: int, num_landmarks: int, num_steps: int, seeds: list[int]) -> dict:
+    runs = [run_once(name, num_particles, num_landmarks, num_steps, seed) for seed in seeds]
+    # memory depends on the sizes, not on the noise, one traced run is enough
+    peak_memory = run_once(name, num_particles, num_landmarks, num_steps, seeds[0], trace_memory=True)["peak_memory"]
+
+    step_ms = np.concatenate([run["step_times"] for run in runs]) * 1000.0
+    squared_errors = np.concatenate([run["squared_errors"] for run in runs])
+    final_errors = np.sqrt([run["squared_errors"][-1] for run in runs])
+    return {
+        "filter": name,
+        "num_particles": num_particles,
+        "num_landmarks": num_landmarks,
+        "num_steps": num_steps,
+        "mean_step_ms": float(step_ms.mean()),
+        "p95_step_ms": float(np.percentile(step_ms, 95)),
+        "peak_memory_kib": peak_memory / 1024.0,
+        "rmse": float(np.sqrt(squared_errors.mean())),
+        "mean_final_error": float(final_errors.mean()),
+        "resampled_share": sum(run["resampling"]["resampled"] for run in runs) / sum(run["resampling"]["steps"] for run in runs),
+    }
+
+def run_grid(filters: list[str], particle_counts: list[int], landmark_counts: list[int], step_counts: list[int], seeds: list[int]) -> list[dict]:
+    results = []
+    for name, num_particles, num_landmarks, num_steps in itertools.product(filters, particle_counts, landmark_counts, step_counts):
+        results.append(run_config(name, num_particles, num_landmarks, num_steps, seeds))
+    return results
+
+def config_key(result: dict) -> tuple:
+    return result["filter"], result["num_particles"], result["num_landmarks"], result["num_steps"]
+
+def print_table(results: list[dict], baseline: list[dict] = None) -> None:
+    # with a baseline (report of an earlier version), speedup and RMSE change are shown for matching rows
+    baseline = {config_key(result): result for result in baseline or []}
+    header = f"{'filter':<9}{'particles':>10}{'landmarks':>10}{'steps':>7}{'step [ms]':>11}{'p95 [ms]':>10}{'peak [KiB]':>12}{'RMSE':>9}{'final':>9}{'resampled':>11}"
+    if baseline:
+        header += f"{'speedup':>9}{'RMSE diff':>11}"
+    print("\n ---- LANDMARK FILTER BENCHMARK ---- \n")
+    print(header)
+    for result in results:
+        line = (f"{result['filter']:<9}{result['num_particles']:>10}{result['num_landmarks']:>10}{result['num_steps']:>7}"
+                f"{result['mean_step_ms']:>11.3f}{result['p95_step_ms']:>10.3f}{result['peak_memory_kib']:>12.0f}"
+                f"{result['rmse']:>9.3f}{result['mean_final_error']:>9.3f}{result['resampled_share']:>11.0%}")
+        old = baseline.get(config_key(result))
+        if old is not None:
+            line += f"{old['mean_step_ms'] / result['mean_step_ms']:>9.2f}{result['rmse'] - old['rmse']:>+11.3f}"
+        print(line)
+    print()
+
+##################################################################
+# MAIN ###########################################################
+##################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Headless speed and accuracy benchmark of the landmark particle filters")
+    parser.add_argument("--filters", nargs="+", default=FILTERS, choices=FILTERS)
+    parser.add_argument("--particles", type=int, nargs="+", default=PARTICLE_COUNTS)
+    parser.add_argument("--landmarks", type=int, nargs="+", default=LANDMARK_COUNTS)
+    parser.add_argument("--steps", type=int, nargs="+", default=STEP_COUNTS)
+    parser.add_argument("--repeats", type=int, default=NUM_REPEATS, help="runs with different seeds per configuration")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first repeat, same seed -> identical runs, comparable between versions")
+    parser.add_argument("--baseline", help="JSON report of an earlier run, adds speedup and RMSE change columns")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    seeds = list(range(args.seed, args.seed + args.repeats))
+    results = run_grid(args.filters, args.particles, args.landmarks, args.steps, seeds)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    print_table(results, baseline)
+
+    if args.output:
+        report = {
+            "config": {"filters": args.filters, "particles": args.particles, "landmarks": args.landmarks, "steps": args.steps, "seeds": seeds},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Report saved to {args.output}")
+
+##################################################################
+if __name__ == "__main__":
+    main()
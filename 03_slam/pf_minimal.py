@@ -1,5 +1,14 @@
 from matplotlib import pylab as plt
-import math, random
+import math
+import os
+import sys
+
+# random_streams, landmark_measurements and particle_weights are shared with 02_particle_filter, one copy lives there
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "02_particle_filter"))
+
+from random_streams import RandomStream
+from landmark_measurements import measurement_errors
+from particle_weights import gaussian_log_likelihood, reweight, SelectiveResampler
 
 #########################
 # CONSTANTS
@@ -12,8 +21,11 @@ LANDMARK_POSITIONS = [(2.0, 2.0), (2.0, -3.0), (3.0, 3.0), (5.0, -3), (5.0, 2.5)
 
 STD_ANGLE = 0.2
 STD_DISTANCE = 0.2
+STD_MEASUREMENT = 0.1
 
 ANIM_PAUSE = 0.3
+SEED = None     # set an int to get the same run every time
+RESAMPLE_THRESHOLD = 0.5    # resample only when ESS < threshold * N, 1.0 = every step
 
 #########################
 # METHODS
@@ -24,14 +36,14 @@ def motion_model(pose, phi, d):
     y = y + d * math.sin(theta)
     return x, y, theta
 
-def move_robot(pose):
-    angle = random.gauss(0.0, 0.05)
-    distance = DEF_STEP + random.gauss(0.0, 0.1)
+def move_robot(pose, rng):
+    angle = rng.gauss(0.0, 0.05)
+    distance = DEF_STEP + rng.gauss(0.0, 0.1)
     return motion_model(pose, angle, distance)
 
-def update_particle(pose):
-    angle = random.gauss(0.0, STD_ANGLE)
-    distance = DEF_STEP + random.gauss(0.0, STD_DISTANCE)
+def update_particle(pose, rng):
+    angle = rng.gauss(0.0, STD_ANGLE)
+    distance = DEF_STEP + rng.gauss(0.0, STD_DISTANCE)
     return motion_model(pose, angle, distance)
 
 def calculate_distance(point_a, point_b):
@@ -39,62 +51,60 @@ def calculate_distance(point_a, point_b):
     xb, yb = point_b
     return math.sqrt((xa - xb)**2 + (ya - yb)**2)
 
-def measure_distance(pose, landmark):
-    noise = random.gauss(0.0, 0.01)
+def measure_distance(pose, landmark, rng):
+    noise = rng.gauss(0.0, 0.01)
     return calculate_distance(pose[:2], landmark[:2]) + noise
 
-def update_weights(particles, landmarks, measurements):
-    weights = []
-    for particle in particles:
-        total_error = 0.0
-        for landmark, measurement in zip(landmarks, measurements):
-            distance = calculate_distance(particle[:2], landmark[:2])
-            error = abs(measurement - distance)**2
-            total_error += error
-        weight = 1.0 / (total_error + 0.0001) # safety check
-        weights.append(weight)
-    total_weights = sum(weights)
-    return [w / total_weights for w in weights]
+def update_weights(particles, landmarks, measurements, weights):
+    # squared distance errors to all landmarks, all particles at once -> gaussian likelihood in the log domain
+    total_errors = measurement_errors(particles, landmarks, measurements)
+    return reweight(weights, gaussian_log_likelihood(total_errors, STD_MEASUREMENT)).tolist()
         
-def resample(particles, weights):
-    return random.choices(particles, weights, k=len(particles))
+def resample(particles, weights, rng):
+    return rng.choices(particles, weights, k=len(particles))
 
-def get_estimate(particles):
+def get_estimate(particles, weights):
     px, py, ptheta = zip(*particles)
-    num = len(particles)
-    avg_x = sum(px) / num
-    avg_y = sum(py) / num
-    avg_theta = sum(ptheta) / num
+    avg_x = sum(w * x for w, x in zip(weights, px))
+    avg_y = sum(w * y for w, y in zip(weights, py))
+    avg_theta = sum(w * theta for w, theta in zip(weights, ptheta))
     return avg_x, avg_y, avg_theta
 
 #########################
 # MAIN
-state = (0.0, 0.0, 0.0)
-particles = [(0.0, 0.0, 0.0) for _ in range(NUM_PARTICLES)]
-
-plt.figure()
-plt.plot(state[0], state[1], 'ro')
-lx, ly = zip(*LANDMARK_POSITIONS)
-plt.plot(lx, ly, 'ko')
-px, py, _ = zip(*particles)
-plt.plot(px, py, 'go', alpha=0.2, markersize=3)
-
-plt.xlim(MAP_X_MIN, MAP_X_MAX)
-plt.ylim(MAP_Y_MIN, MAP_Y_MAX)
-plt.pause(ANIM_PAUSE)
-
-for step in range(NUM_STEPS):
-    state = move_robot(state)
-    particles = [update_particle(p) for p in particles]
-    measurements = [measure_distance(state, lm) for lm in LANDMARK_POSITIONS]
-    weights = update_weights(particles, LANDMARK_POSITIONS, measurements)
-    particles = resample(particles, weights)
-    estimated_state = get_estimate(particles)
-
+if __name__ == "__main__":
+    rng_robot, rng_sensor, rng_particles = RandomStream(SEED).spawn(3)
+    state = (0.0, 0.0, 0.0)
+    particles = [(0.0, 0.0, 0.0) for _ in range(NUM_PARTICLES)]
+    weights = [1.0 / NUM_PARTICLES] * NUM_PARTICLES
+    resampler = SelectiveResampler(RESAMPLE_THRESHOLD)
+
+    plt.figure()
+    plt.plot(state[0], state[1], 'ro')
+    lx, ly = zip(*LANDMARK_POSITIONS)
+    plt.plot(lx, ly, 'ko')
     px, py, _ = zip(*particles)
     plt.plot(px, py, 'go', alpha=0.2, markersize=3)
-    plt.plot(state[0], state[1], 'ro')
-    plt.plot(estimated_state[0], estimated_state[1], 'bo', markersize=5)
+
+    plt.xlim(MAP_X_MIN, MAP_X_MAX)
+    plt.ylim(MAP_Y_MIN, MAP_Y_MAX)
     plt.pause(ANIM_PAUSE)
 
-plt.show()
\ No newline at end of file
+    for step in range(NUM_STEPS):
+        state = move_robot(state, rng_robot)
+        particles = [update_particle(p, rng_particles) for p in particles]
+        measurements = [measure_distance(state, lm, rng_sensor) for lm in LANDMARK_POSITIONS]
+        weights = update_weights(particles, LANDMARK_POSITIONS, measurements, weights)
+        if resampler.needs_resampling(weights):
+            particles = resampler.run(resample, particles, weights, rng_particles)
+            weights = [1.0 / NUM_PARTICLES] * NUM_PARTICLES
+        estimated_state = get_estimate(particles, weights)
+
+        px, py, _ = zip(*particles)
+        plt.plot(px, py, 'go', alpha=0.2, markersize=3)
+        plt.plot(state[0], state[1], 'ro')
+        plt.plot(estimated_state[0], estimated_state[1], 'bo', markersize=5)
+        plt.pause(ANIM_PAUSE)
+
+    print(resampler.report())
+    plt.show()
@@ -1,5 +1,15 @@
 from matplotlib import pylab as plt
-import math, random, copy
+import numpy as np
+import math
+import os
+import sys
+
+# random_streams, landmark_measurements and particle_weights are shared with 02_particle_filter, one copy lives there
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "02_particle_filter"))
+
+from random_streams import RandomStream
+from landmark_measurements import predict_measurements, measurement_errors
+from particle_weights import gaussian_log_likelihood, reweight, effective_sample_size, SelectiveResampler
 
 #########################
 # CONSTANTS
@@ -10,7 +20,11 @@ MAP_X_MIN, MAP_X_MAX = -1.0, 11.0
 MAP_Y_MIN, MAP_Y_MAX = -6.0, 6.0
 LANDMARK_POSITIONS = [(2.0, 2.0), (2.0, -3.0), (3.0, 3.0), (5.0, -3), (5.0, 2.5), (8.0, -2.0), (9.0, 3.0)]
 
+STD_MEASUREMENT = 0.1    # how much the filter trusts one landmark reading (distance and angle)
+RESAMPLE_THRESHOLD = 0.5    # resample only when ESS < threshold * N, 1.0 = every step
+
 ANIM_PAUSE = 0.3
+SEED = None     # set an int to get the same run every time
 
 #########################
 # METHODS
@@ -36,26 +50,26 @@ def measurement_model(pose: tuple[float, float, float], target: tuple[float, flo
 #########################
 # CLASSES
 class Sensor:
-    def __init__(self, std_distance=0.01, std_angle=0.001):
+    def __init__(self, std_distance=0.01, std_angle=0.001, rng=None):
         self.std_distance = std_distance
         self.std_angle = std_angle
         self.last_measurement = []
+        self.rng = rng if rng is not None else RandomStream()
 
     def read(self, pose, map):
-        measurements = []
-        for feature in map:
-            noise_distance = random.gauss(0.0, self.std_distance)
-            noise_angle = random.gauss(0.0, self.std_angle)
-            angle_measured, distance_measured = measurement_model(pose, feature)
-            measurement = normalize_angle(angle_measured + noise_angle), distance_measured + noise_distance
-            measurements.append(measurement)
-        self.last_measurement = measurements
+        # all landmarks at once, one (distance, angle) noise pair per landmark
+        noise = self.rng.normal(0.0, 1.0, (len(map), 2)) * (self.std_distance, self.std_angle)
+        angles, distances = predict_measurements(pose, map)
+        angles = normalize_angle(angles[0] + noise[:, 1])
+        distances = distances[0] + noise[:, 0]
+        self.last_measurement = list(zip(angles.tolist(), distances.tolist()))
 
 class Robot:
-    def __init__(self, pose=(0.0, 0.0, 0.0), std_distance=0.1, std_angle=0.1):
+    def __init__(self, pose=(0.0, 0.0, 0.0), std_distance=0.1, std_angle=0.1, rng=None):
         self.x, self.y, self.theta = pose
         self.std_distance = std_distance
         self.std_angle = std_angle
+        self.rng = rng if rng is not None else RandomStream()
 
     def get_pose(self):
         return self.x, self.y, self.theta
@@ -64,63 +78,149 @@ class Robot:
         self.x, self.y, self.theta = pose
 
     def move(self, angle_cmd, distance_cmd):
-        angle = angle_cmd + random.gauss(0.0, self.std_angle)
-        distance = distance_cmd + random.gauss(0.0, self.std_distance)
+        angle = angle_cmd + self.rng.gauss(0.0, self.std_angle)
+        distance = distance_cmd + self.rng.gauss(0.0, self.std_distance)
         self.set_pose(motion_model(self.get_pose(), angle, distance))
 
     def draw(self):
         plt.plot(self.x, self.y, 'ro')
 
 class Particle(Robot):
-    def __init__(self, pose=(0, 0, 0), std_distance=0.2, std_angle=0.2):
-        super().__init__(pose, std_distance, std_angle)
+    def __init__(self, pose=(0, 0, 0), std_distance=0.2, std_angle=0.2, rng=None):
+        super().__init__(pose, std_distance, std_angle, rng)
         self.error = 0.0
 
     def update_error(self, measurements, map):
-        self.error = 0.0
-        for measurement, feature in zip(measurements, map):
-            angle_measured, distance_measured = measurement
-            angle_particle, distance_particle = measurement_model(self.get_pose(), feature)
-            error_distance = abs(distance_measured - distance_particle)**2
-            error_angle = abs(angle_measured - angle_particle)**2
-            self.error += error_distance + error_angle
+        angle_measured, distance_measured = zip(*measurements)
+        self.error = float(measurement_errors(self.get_pose(), map, distance_measured, angle_measured)[0])
+
+class ParticleSet:
+    # all particles in contiguous arrays: poses (N, 3) as x, y, theta and errors (N,)
+    # moving, scoring and resampling work on the whole set at once, no Particle objects are created or copied
+    # indexing / iterating still gives Particle-like views, e.g. pf.particles[0].x or p.get_pose()
+    def __init__(self, num_particles=300, std_distance=0.2, std_angle=0.2, rng=None):
+        self.poses = np.zeros((num_particles, 3))
+        self.errors = np.zeros(num_particles)
+        self.std_distance = std_distance
+        self.std_angle = std_angle
+        self.rng = rng if rng is not None else RandomStream()
+
+    def __len__(self):
+        return len(self.poses)
+
+    def __getitem__(self, index):
+        # a slice gives a list of views, like slicing the former list of particles
+        if isinstance(index, slice):
+            return [ParticleView(self, i) for i in range(len(self))[index]]
+        return ParticleView(self, range(len(self))[index])
+
+    def __iter__(self):
+        return (ParticleView(self, i) for i in range(len(self)))
+
+    def move(self, angle_cmd, distance_cmd):
+        # Robot.move for every particle, each with its own noise
+        n = len(self)
+        angle = angle_cmd + self.rng.normal(0.0, self.std_angle, n)
+        distance = distance_cmd + self.rng.normal(0.0, self.std_distance, n)
+        theta = self.poses[:, 2] + angle
+        self.poses[:, 0] += distance * np.cos(theta)
+        self.poses[:, 1] += distance * np.sin(theta)
+        self.poses[:, 2] = theta
+
+    def update_error(self, measurements, map):
+        # Particle.update_error for every particle in one pass over the (N, M) particle-landmark pairs
+        angle_measured, distance_measured = np.array(measurements).T
+        self.errors = measurement_errors(self.poses, map, distance_measured, angle_measured)
+
+    def select(self, indices):
+        # resampling is a gather of rows, the new set owns its arrays
+        self.poses = self.poses[indices]
+        self.errors = self.errors[indices]
+
+class ParticleView(Particle):
+    # one row of a ParticleSet with the Particle interface, reads and writes go to the arrays
+    def __init__(self, particle_set, index):
+        self.particle_set = particle_set
+        self.index = index
+
+    @property
+    def x(self):
+        return float(self.particle_set.poses[self.index, 0])
+
+    @x.setter
+    def x(self, value):
+        self.particle_set.poses[self.index, 0] = value
+
+    @property
+    def y(self):
+        return float(self.particle_set.poses[self.index, 1])
+
+    @y.setter
+    def y(self, value):
+        self.particle_set.poses[self.index, 1] = value
+
+    @property
+    def theta(self):
+        return float(self.particle_set.poses[self.index, 2])
+
+    @theta.setter
+    def theta(self, value):
+        self.particle_set.poses[self.index, 2] = value
+
+    @property
+    def error(self):
+        return float(self.particle_set.errors[self.index])
+
+    @error.setter
+    def error(self, value):
+        self.particle_set.errors[self.index] = value
+
+    @property
+    def std_distance(self):
+        return self.particle_set.std_distance
+
+    @property
+    def std_angle(self):
+        return self.particle_set.std_angle
+
+    @property
+    def rng(self):
+        return self.particle_set.rng
 
 class ParticleFilter:
-    def __init__(self, num_particles=300, std_distance=0.2, std_angle=0.2):
+    def __init__(self, num_particles=300, std_distance=0.2, std_angle=0.2, resample_threshold=RESAMPLE_THRESHOLD, rng=None):
         self.num_particles = num_particles
-        self.particles = [
-            Particle(std_distance=std_distance, std_angle=std_angle) for _ in range(num_particles)
-        ]
+        self.rng = rng if rng is not None else RandomStream()
+        self.particles = ParticleSet(num_particles, std_distance, std_angle, self.rng)
+        self.resampler = SelectiveResampler(resample_threshold)
+        self.weights = np.full(num_particles, 1.0 / num_particles)
+        self.ess = float(num_particles)
         self.x_avg = 0.0
         self.y_avg = 0.0
         self.theta_avg = 0.0
     
     def update(self, angle, step, measurements, map):
-        for p in self.particles:
-            p.move(angle, step)
-            p.update_error(measurements, map)
+        self.particles.move(angle, step)
+        self.particles.update_error(measurements, map)
+        # errors are summed squares -> gaussian likelihood, weights carried over from the last step
+        self.weights = reweight(self.weights, gaussian_log_likelihood(self.particles.errors, STD_MEASUREMENT))
+        self.ess = float(effective_sample_size(self.weights))
     
     def resample(self):
-        weights = [(1.0 / p.error) for p in self.particles]
-        total_weights = sum(weights)
-        weights_norm = [w / total_weights for w in weights]
+        # only when the weights degenerated, otherwise the particles keep their weights and diversity
+        if self.resampler.needs_resampling(self.weights):
+            self.resampler.run(self._resample)
 
-        new_particles = random.choices(self.particles, weights_norm, k=len(self.particles))
-        self.particles = [copy.deepcopy(p) for p in new_particles]
+    def _resample(self):
+        indices = self.rng.choice(len(self.particles), size=len(self.particles), p=self.weights)
+        self.particles.select(indices)
+        self.weights = np.full(len(self.particles), 1.0 / len(self.particles))
 
     def estimate(self):
-        sum_x, sum_y, sum_theta = 0.0, 0.0, 0.0
-        num = len(self.particles)
-        for p in self.particles:
-            sum_x += p.x
-            sum_y += p.y
-            sum_theta += p.theta
-        self.x_avg = sum_x/num
-        self.y_avg = sum_y/num
-        self.theta_avg = sum_theta/num
+        self.x_avg, self.y_avg, self.theta_avg = np.average(self.particles.poses, axis=0, weights=self.weights)
 
     def draw_particles(self):
-        px, py = zip(*[(p.x, p.y) for p in self.particles])
+        px, py = self.particles.poses[:, 0], self.particles.poses[:, 1]
         plt.plot(px, py, 'go', alpha=0.2, markersize=3)
 
     def draw_estimate(self):
@@ -130,9 +230,10 @@ class ParticleFilter:
 # MAIN
 if __name__ == "__main__":
     map = LANDMARK_POSITIONS
-    robot = Robot()
-    pf = ParticleFilter(num_particles=400)
-    sensor = Sensor()
+    rng_robot, rng_sensor, rng_particles = RandomStream(SEED).spawn(3)
+    robot = Robot(rng=rng_robot)
+    pf = ParticleFilter(num_particles=400, rng=rng_particles)
+    sensor = Sensor(rng=rng_sensor)
 
     plt.figure()
     pf.draw_particles()
@@ -160,4 +261,5 @@ if __name__ == "__main__":
         pf.draw_estimate()
         plt.pause(ANIM_PAUSE)
 
+    print(pf.resampler.report())
     plt.show()
\ No newline at end of file
@@ -1,5 +1,13 @@
 import matplotlib.pylab as plt
-import math, random, copy
+import math, copy
+import os
+import sys
+
+# random_streams, landmark_measurements and particle_weights are shared with 02_particle_filter, one copy lives there
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "02_particle_filter"))
+
+from random_streams import RandomStream
+from particle_weights import reweight, SelectiveResampler
 
 #########################
 # CONSTANTS
@@ -11,6 +19,8 @@ MAP_Y_MIN, MAP_Y_MAX = -6.0, 6.0
 LANDMARK_POSITIONS = [(2.0, 2.0), (2.0, -3.0), (3.0, 3.0), (5.0, -3), (5.0, 2.5), (8.0, -2.0), (9.0, 3.0)]
 
 ANIM_PAUSE = 0.3
+SEED = None     # set an int to get the same run every time
+RESAMPLE_THRESHOLD = 0.5    # resample only when ESS < threshold * N, 1.0 = every step
 
 COLOR_TRUE_LANDMARK         = '#0d0d0d'
 COLOR_ROBOT                 = '#d83034'
@@ -44,17 +54,18 @@ def measurement_model(pose: tuple[float, float, float], target: tuple[float, flo
 #########################
 # CLASSES
 class Sensor:
-    def __init__(self, range=8.0, std_distance=0.01, std_angle=0.001):
+    def __init__(self, range=8.0, std_distance=0.01, std_angle=0.001, rng=None):
         self.std_distance = std_distance
         self.std_angle = std_angle
         self.last_measurement = []
         self.range_distance = range
+        self.rng = rng if rng is not None else RandomStream()
 
     def read_inf(self, pose, map):
         measurements = []
         for feature in map:
-            noise_distance = random.gauss(0.0, self.std_distance)
-            noise_angle = random.gauss(0.0, self.std_angle)
+            noise_distance = self.rng.gauss(0.0, self.std_distance)
+            noise_angle = self.rng.gauss(0.0, self.std_angle)
             angle_measured, distance_measured = measurement_model(pose, feature)
             measurement = normalize_angle(angle_measured + noise_angle), distance_measured + noise_distance
             measurements.append(measurement)
@@ -65,17 +76,18 @@ class Sensor:
         for feature in map:
             angle_measured, distance_measured = measurement_model(pose, feature)
             if distance_measured < self.range_distance:
-                noise_distance = random.gauss(0.0, self.std_distance)
-                noise_angle = random.gauss(0.0, self.std_angle)
+                noise_distance = self.rng.gauss(0.0, self.std_distance)
+                noise_angle = self.rng.gauss(0.0, self.std_angle)
                 measurement = normalize_angle(angle_measured + noise_angle), distance_measured + noise_distance
                 measurements.append(measurement)
         self.last_measurement = measurements
 
 class Robot:
-    def __init__(self, pose=(0.0, 0.0, 0.0), std_distance=0.1, std_angle=0.1):
+    def __init__(self, pose=(0.0, 0.0, 0.0), std_distance=0.1, std_angle=0.1, rng=None):
         self.x, self.y, self.theta = pose
         self.std_distance = std_distance
         self.std_angle = std_angle
+        self.rng = rng if rng is not None else RandomStream()
 
     def get_pose(self):
         return self.x, self.y, self.theta
@@ -84,13 +96,13 @@ class Robot:
         self.x, self.y, self.theta = pose
 
     def move(self, angle_cmd, distance_cmd):
-        angle = angle_cmd + random.gauss(0.0, self.std_angle)
-        distance = distance_cmd + random.gauss(0.0, self.std_distance)
+        angle = angle_cmd + self.rng.gauss(0.0, self.std_angle)
+        distance = distance_cmd + self.rng.gauss(0.0, self.std_distance)
         self.set_pose(motion_model(self.get_pose(), angle, distance))
 
 class Particle(Robot):
-    def __init__(self, pose=(0, 0, 0), std_distance=0.2, std_angle=0.2):
-        super().__init__(pose, std_distance, std_angle)
+    def __init__(self, pose=(0, 0, 0), std_distance=0.2, std_angle=0.2, rng=None):
+        super().__init__(pose, std_distance, std_angle, rng)
         self.error = 0.0
         self.map = []
 
@@ -126,29 +138,37 @@ class Particle(Robot):
                 self.error += 0.2 + 0.1 * best_distance
 
 class Slam:
-    def __init__(self, num_particles=300, treshold=2.0, std_distance=0.2, std_angle=0.2):
+    def __init__(self, num_particles=300, treshold=2.0, std_distance=0.2, std_angle=0.2, resample_threshold=RESAMPLE_THRESHOLD, rng=None):
         self.num_particles = num_particles
+        # all particles share one stream (deepcopy keeps sharing it, see RandomStream)
+        self.rng = rng if rng is not None else RandomStream()
         self.particles = [
-            Particle(std_distance=std_distance, std_angle=std_angle) for _ in range(num_particles)
+            Particle(std_distance=std_distance, std_angle=std_angle, rng=self.rng) for _ in range(num_particles)
         ]
         self.x_avg = 0.0
         self.y_avg = 0.0
         self.theta_avg = 0.0
         self.treshold_association = treshold
+        self.weights = [1.0 / num_particles] * num_particles
+        self.resampler = SelectiveResampler(resample_threshold)
     
     def update(self, angle, step, measurements):
         for p in self.particles:
             p.move(angle, step)
             p.update_error(measurements, self.treshold_association)
+        # old weight * exp(-10 * error), in the log domain so big errors do not round every weight to 0
+        self.weights = reweight(self.weights, [-p.error * 10.0 for p in self.particles]).tolist()
     
     def resample(self):
-        weights = [math.exp(-p.error * 10.0) for p in self.particles]
-        total_weights = sum(weights)
-        weights_norm = [w / total_weights for w in weights]
-        
+        # copying every particle with its map is expensive, only done when the weights degenerated
+        if self.resampler.needs_resampling(self.weights):
+            self.resampler.run(self._resample)
+    
+    def _resample(self):
+        weights_norm = self.weights
         new_particles = []
         N = len(self.particles)
-        r = random.uniform(0, 1.0 / N)
+        r = self.rng.uniform(0, 1.0 / N)
         c = weights_norm[0]
         i = 0
         for m in range(N):
@@ -158,10 +178,11 @@ class Slam:
                 c += weights_norm[i]
             new_particles.append(copy.deepcopy(self.particles[i]))
         self.particles = new_particles
+        self.weights = [1.0 / N] * N
 
     def estimate(self):
         x_y_theta = zip(*[(p.x, p.y, p.theta) for p in self.particles])
-        self.x_avg, self.y_avg, self.theta_avg = [sum(x)/len(self.particles) for x in x_y_theta]
+        self.x_avg, self.y_avg, self.theta_avg = [sum(w * v for w, v in zip(self.weights, x)) for x in x_y_theta]
         
     def get_pose_estimated(self):
         return self.x_avg, self.y_avg, self.theta_avg
@@ -200,9 +221,10 @@ def setup_axis(ax:plt.Axes, title:str):
 # MAIN
 if __name__ == "__main__":
     map = LANDMARK_POSITIONS
-    robot = Robot()
-    slam = Slam(num_particles=300, treshold=1.0, std_angle=0.2, std_distance=0.2)
-    sensor = Sensor()
+    rng_robot, rng_sensor, rng_particles = RandomStream(SEED).spawn(3)
+    robot = Robot(rng=rng_robot)
+    slam = Slam(num_particles=300, treshold=1.0, std_angle=0.2, std_distance=0.2, rng=rng_particles)
+    sensor = Sensor(rng=rng_sensor)
     
     turn = 0.0
     step = DEF_STEP
@@ -324,5 +346,6 @@ if __name__ == "__main__":
         
         plt.pause(ANIM_PAUSE)
         
+    print(slam.resampler.report())
     plt.ioff()
     plt.show()
\ No newline at end of file